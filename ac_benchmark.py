@@ -0,0 +1,417 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+benchmark the account creation check script without going near the
+analytics replicas: generate a source wiki, a loginwiki and a
+centralauth db full of synthetic accounts in local sqlite files,
+point the script at them through the fake_mysqldb stand-in for
+MySQLdb, and time each action
+
+each action runs in a fresh process so that its peak memory use can
+be measured on its own; the results are written to a json file so
+that runs against different versions of the script can be compared
+"""
+
+import getopt
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import sys
+import time
+
+import account_creation_check as acc
+import fake_mysqldb
+
+KNOWN_ACTIONS = ['source', 'login', 'compare', 'gone', 'global']
+SOURCE_WIKI = 'enwiki'
+LOGIN_WIKI = 'loginwiki'
+GLOBAL_DB = 'centralauth'
+
+
+def usage(message=None):
+    '''
+    display a helpful usage message with
+    an optional introductory message first
+    '''
+
+    if message is not None:
+        sys.stderr.write(message)
+        sys.stderr.write('\n')
+    usage_message = """
+Usage: python3 ac_benchmark.py [--actions <item,item,item>] [--accounts <num>]
+    [--overlap <ratio>] [--missing <ratio>] [--global <ratio>] [--latency <ms>]
+    [--batchsize <num>] [--format <text|binary>] [--compression <none|gzip|zstd>]
+    [--workdir <dir>] [--output <path>] [--label <text>] [--help]
+
+This script generates synthetic user accounts for a source wiki, loginwiki and
+    centralauth in sqlite files, runs the actions of account_creation_check.py
+    against them with a fake MySQLdb module, and records the time, throughput
+    and peak memory use of each action to a json file.
+
+Arguments:
+
+     --actions          (-a):  actions to time, separated by a comma
+                               possible choices: source, login, compare, gone, global
+                               default: all of them
+     --accounts         (-n):  number of accounts to create on the source wiki
+                               default: 1000000
+     --overlap          (-O):  fraction of the source wiki accounts which are also
+                               in the loginwiki uid interval that is checked
+                               default: 0.9
+     --missing          (-m):  fraction of the remaining source wiki accounts which are
+                               not on loginwiki at all; the others are on loginwiki but
+                               with uids before the interval that is checked
+                               default: 0.5
+     --global           (-g):  fraction of the accounts not on loginwiki which are
+                               in the global user table
+                               default: 0.5
+     --latency          (-t):  milliseconds each connection and query should take
+                               default: 0
+     --batchsize        (-b):  batchsize setting for the script
+                               default: 10000
+     --format           (-f):  output_format setting for the script, text or binary
+                               default: text
+     --compression      (-z):  output_compression setting for the script, none, gzip
+                               or zstd
+                               default: none
+     --workdir          (-w):  directory for the sqlite files, config and output files;
+                               data generated with the same options is reused
+                               default: bench subdirectory in current working directory
+     --output           (-o):  path of the json file for the results
+                               default: bench_results.json in the work directory
+     --label            (-l):  text to include in the results, to tell runs apart
+                               default: none
+     --help             (-h):  display this message
+"""
+    sys.stderr.write(usage_message)
+    sys.exit(1)
+
+
+def get_args():
+    '''
+    get and validate (somewhat) options, returning a dict of them
+    '''
+    args = {'actions': KNOWN_ACTIONS, 'accounts': 1000000, 'overlap': 0.9, 'missing': 0.5,
+            'global': 0.5, 'latency': 0.0, 'batchsize': 10000, 'format': 'text',
+            'compression': 'none',
+            'workdir': os.path.join(os.getcwd(), "bench"), 'output': None, 'label': ''}
+    try:
+        (options, remainder) = getopt.gnu_getopt(
+            sys.argv[1:], 'a:n:O:m:g:t:b:f:z:w:o:l:h',
+            ['actions=', 'accounts=', 'overlap=', 'missing=', 'global=', 'latency=',
+             'batchsize=', 'format=', 'compression=', 'workdir=', 'output=', 'label=', 'help'])
+    except getopt.GetoptError as err:
+        usage("Unknown option specified: " + str(err))
+    if remainder:
+        usage(f"Unknown option(s) specified: {remainder[0]}")
+
+    try:
+        for (opt, val) in options:
+            if opt in ["-a", "--actions"]:
+                args['actions'] = val.split(",")
+            elif opt in ["-n", "--accounts"]:
+                args['accounts'] = int(val)
+            elif opt in ["-O", "--overlap"]:
+                args['overlap'] = float(val)
+            elif opt in ["-m", "--missing"]:
+                args['missing'] = float(val)
+            elif opt in ["-g", "--global"]:
+                args['global'] = float(val)
+            elif opt in ["-t", "--latency"]:
+                args['latency'] = float(val) / 1000
+            elif opt in ["-b", "--batchsize"]:
+                args['batchsize'] = int(val)
+            elif opt in ["-f", "--format"]:
+                if val not in ['text', 'binary']:
+                    raise ValueError(f"format must be text or binary, not {val}")
+                args['format'] = val
+            elif opt in ["-z", "--compression"]:
+                if val not in acc.COMPRESSIONS:
+                    raise ValueError(f"compression must be one of {', '.join(acc.COMPRESSIONS)}")
+                args['compression'] = val
+            elif opt in ["-w", "--workdir"]:
+                args['workdir'] = val
+            elif opt in ["-o", "--output"]:
+                args['output'] = val
+            elif opt in ["-l", "--label"]:
+                args['label'] = val
+            elif opt in ["-h", "--help"]:
+                usage("Help for this script")
+    except ValueError as ex:
+        usage(f"Bad value for option: {ex}")
+
+    for action in args['actions']:
+        if action not in KNOWN_ACTIONS:
+            usage(f"Unknown action specified: {action}, known are {KNOWN_ACTIONS}")
+    if not args['output']:
+        args['output'] = os.path.join(args['workdir'], "bench_results.json")
+    return args
+
+
+def create_user_db(path, table, prefix):
+    '''
+    create a sqlite db with an empty user or globaluser table, the
+    columns named with the given prefix, and return a connection to it
+    '''
+    if os.path.exists(path):
+        os.unlink(path)
+    dbconn = sqlite3.connect(path)
+    dbconn.execute(f"CREATE TABLE {table} ({prefix}_id INTEGER PRIMARY KEY, "
+                   f"{prefix}_name BLOB NOT NULL, {prefix}_registration BLOB)")
+    return dbconn
+
+
+def add_user_index(dbconn, table, prefix):
+    '''
+    add the unique name index, after the rows are in since that's faster
+    '''
+    dbconn.execute(f"CREATE UNIQUE INDEX {prefix}_name ON {table} ({prefix}_name)")
+    dbconn.commit()
+    dbconn.close()
+
+
+def get_timestamp(uid, total):
+    '''
+    make up a registration date for a uid, with uids spread evenly
+    over the last year and later uids registering later
+    '''
+    seconds = int(time.time()) - 365 * 86400 + (uid * 365 * 86400) // max(total, 1)
+    return time.strftime("%Y%m%d%H%M%S", time.gmtime(seconds)).encode('utf-8')
+
+
+def generate_data(args):
+    '''
+    create the sqlite files for the source wiki, loginwiki and centralauth,
+    unless ones made with the same options already exist; return the source
+    and loginwiki uid intervals to check
+    '''
+    datadir = os.path.join(args['workdir'], "data")
+    os.makedirs(datadir, exist_ok=True)
+    params = {key: args[key] for key in ['accounts', 'overlap', 'missing', 'global']}
+    params_path = os.path.join(datadir, "params.json")
+    if os.path.exists(params_path):
+        with open(params_path, "r", encoding="utf-8") as params_in:
+            existing = json.load(params_in)
+        if existing['params'] == params:
+            return existing['intervals']
+
+    rand = random.Random(42)
+    accounts = args['accounts']
+    # which source accounts are in the loginwiki interval, on loginwiki
+    # before the interval, or not on loginwiki at all (and maybe global)
+    in_window = []
+    old = []
+    gone = []
+    for uid in range(1, accounts + 1):
+        name = f"Bench user {uid}"
+        if rand.random() < args['overlap']:
+            in_window.append(name)
+        elif rand.random() >= args['missing']:
+            old.append(name)
+        else:
+            gone.append(name)
+
+    source = create_user_db(os.path.join(datadir, f"{SOURCE_WIKI}.sqlite"), 'user', 'user')
+    source.executemany("INSERT INTO user VALUES (?, ?, ?)",
+                       ((uid, f"Bench user {uid}".encode('utf-8'),
+                         get_timestamp(uid, accounts) if uid % 50 else None)
+                        for uid in range(1, accounts + 1)))
+    add_user_index(source, 'user', 'user')
+
+    # loginwiki: the old accounts plus some only on loginwiki, then the interval
+    # that is checked, where the source accounts are mixed with as many again
+    # created from other wikis
+    login_names = old + [f"Older login user {i}" for i in range(len(old))]
+    login_start = len(login_names) + 1
+    window = in_window + [f"Other wiki user {i}" for i in range(accounts)]
+    rand.shuffle(window)
+    login_names.extend(window)
+    login = create_user_db(os.path.join(datadir, f"{LOGIN_WIKI}.sqlite"), 'user', 'user')
+    login.executemany("INSERT INTO user VALUES (?, ?, ?)",
+                      ((uid, name.encode('utf-8'), get_timestamp(uid, len(login_names)))
+                       for uid, name in enumerate(login_names, start=1)))
+    add_user_index(login, 'user', 'user')
+
+    global_names = [name for name in gone if rand.random() < args['global']]
+    global_names.extend(login_names)
+    centralauth = create_user_db(os.path.join(datadir, f"{GLOBAL_DB}.sqlite"),
+                                 'globaluser', 'gu')
+    centralauth.executemany("INSERT INTO globaluser VALUES (?, ?, ?)",
+                            ((uid, name.encode('utf-8'), get_timestamp(uid, len(global_names)))
+                             for uid, name in enumerate(global_names, start=1)))
+    add_user_index(centralauth, 'globaluser', 'gu')
+
+    intervals = {'source': {'start': 1, 'end': accounts},
+                 'login': {'start': login_start, 'end': len(login_names)}}
+    with open(params_path, "w", encoding="utf-8") as params_out:
+        json.dump({'params': params, 'intervals': intervals}, params_out)
+    return intervals
+
+
+def write_config(args):
+    '''
+    write the dblists and a config file for the script, returning the config path
+    '''
+    dblists_dir = os.path.join(args['workdir'], "dblists")
+    os.makedirs(dblists_dir, exist_ok=True)
+    with open(os.path.join(dblists_dir, "s1.dblist"), "w", encoding="utf-8") as dblist:
+        dblist.write(f"{SOURCE_WIKI}\n")
+    with open(os.path.join(dblists_dir, "s7.dblist"), "w", encoding="utf-8") as dblist:
+        dblist.write(f"{LOGIN_WIKI}\n{GLOBAL_DB}\n")
+    config_path = os.path.join(args['workdir'], "bench_config.ini")
+    with open(config_path, "w", encoding="utf-8") as config:
+        config.write("[main]\n"
+                     f"dblists_dir={dblists_dir}\n"
+                     "hostname_templ={section}-bench.local\n"
+                     "port=3306\n"
+                     f"batchsize={args['batchsize']}\n"
+                     f"output_format={args['format']}\n"
+                     f"output_compression={args['compression']}\n"
+                     "section_cache=\n")
+    return config_path
+
+
+def count_rows(path):
+    '''
+    return the number of entries in a uids file, in either format and
+    compressed or not; binary files are read a block header at a time
+    rather than memory mapped, so that the file doesn't count towards the
+    peak memory of the action
+    '''
+    rows = 0
+    with acc.open_input(path) as infile:
+        header = infile.read(acc.USER_ROWS_HEADER.size)
+        if not header.startswith(acc.USER_ROWS_MAGIC):
+            rows = header.count(b"\n")
+            for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+                rows += chunk.count(b"\n")
+            return rows
+        while header:
+            _magic, count, names_size = acc.USER_ROWS_HEADER.unpack(header)
+            rows += count
+            infile.read((3 * count + 1) * 8 + names_size + (-names_size % 8))
+            header = infile.read(acc.USER_ROWS_HEADER.size)
+    return rows
+
+
+def get_peak_rss():
+    '''
+    return the peak resident memory of this process in kilobytes; ru_maxrss
+    would do, except that on linux it carries over the peak of the parent
+    process from before the exec, so VmHWM is used where there is one
+    '''
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # kilobytes on linux, bytes on macos, close enough
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_action(action, args, config_path, intervals, results):
+    '''
+    run one action of the script against the fake dbs and put
+    the time it took, rows handled and peak memory in results
+    this is run in a process of its own
+    '''
+    fake_mysqldb.configure(os.path.join(args['workdir'], "data"), args['latency'])
+    acc.MySQLdb = fake_mysqldb
+    settings = acc.OptHandler.get_settings(config_path)
+    script_args = acc.OptHandler.get_opt_defaults()
+    outputdir = os.path.join(args['workdir'], "output")
+    script_args['outputdir'] = outputdir
+    count = int(settings['main']['batchsize'])
+    outputs = {stem: os.path.join(outputdir, f"{stem}_bench") for stem in
+               ['source_uids', 'login_uids', 'missing_uids', 'gone_uids', 'global_uids']}
+    wikidb = {'source': SOURCE_WIKI, 'login': LOGIN_WIKI, 'gone': LOGIN_WIKI,
+              'global': GLOBAL_DB}.get(action)
+
+    queries = None
+    if wikidb:
+        dbconn = acc.DBConn(wikidb, 'bench', 'bench', settings)
+        dbconn.get_conn()
+        queries = acc.QueryRunner(dbconn, script_args)
+        queries.init_conn()
+
+    started = time.monotonic()
+    if action == 'source':
+        queries.get_user_batches(intervals['source'], outputs['source_uids'], count)
+        rows = count_rows(outputs['source_uids'])
+    elif action == 'login':
+        queries.get_user_batches(intervals['login'], outputs['login_uids'], count)
+        rows = count_rows(outputs['login_uids'])
+    elif action == 'compare':
+        acc.compare_user_info(outputs['source_uids'], outputs['login_uids'],
+                              outputs['missing_uids'], script_args, settings)
+        rows = count_rows(outputs['source_uids']) + count_rows(outputs['login_uids'])
+    elif action == 'gone':
+        queries.check_missing_uids(outputs['missing_uids'], outputs['gone_uids'])
+        rows = count_rows(outputs['missing_uids'])
+    else:
+        queries.check_global_users(outputs['gone_uids'], outputs['global_uids'])
+        rows = count_rows(outputs['gone_uids'])
+    elapsed = time.monotonic() - started
+
+    results[action] = {
+        'seconds': elapsed,
+        'rows': rows,
+        'rows_per_sec': rows / elapsed if elapsed else None,
+        'peak_rss_kb': get_peak_rss(),
+        'queries': fake_mysqldb.COUNTERS['queries'],
+        'connects': fake_mysqldb.COUNTERS['connects'],
+    }
+
+
+def do_main():
+    '''
+    entry point
+    '''
+    args = get_args()
+    os.makedirs(os.path.join(args['workdir'], "output"), exist_ok=True)
+
+    started = time.monotonic()
+    intervals = generate_data(args)
+    generate_seconds = time.monotonic() - started
+    config_path = write_config(args)
+
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        results = manager.dict()
+        for action in args['actions']:
+            worker = context.Process(target=run_action,
+                                     args=(action, args, config_path, intervals, results))
+            worker.start()
+            worker.join()
+            if worker.exitcode:
+                sys.stderr.write(f"action {action} failed, exit code {worker.exitcode}\n")
+                sys.exit(1)
+            print(f"{action}: {results[action]['rows']} rows in "
+                  f"{results[action]['seconds']:.2f}s, "
+                  f"{results[action]['rows_per_sec'] or 0:.0f} rows/sec, "
+                  f"peak rss {results[action]['peak_rss_kb']} KB")
+        action_results = dict(results)
+
+    report = {
+        'label': args['label'],
+        'date': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'params': {key: args[key] for key in ['accounts', 'overlap', 'missing', 'global',
+                                              'latency', 'batchsize', 'format',
+                                              'compression']},
+        'intervals': intervals,
+        'generate_seconds': generate_seconds,
+        'actions': {action: action_results[action] for action in args['actions']},
+    }
+    with open(args['output'], "w", encoding="utf-8") as output:
+        json.dump(report, output, indent=2)
+        output.write("\n")
+    print(f"results written to {args['output']}")
+
+
+if __name__ == '__main__':
+    do_main()
@@ -17,11 +17,32 @@ on en wiki, 200k on loginwiki ought to get that, and
 there we are.
 """
 
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import getopt
 import glob
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
+import operator
 import os.path
+import queue
+import re
+import shutil
+import struct
 import sys
+import tempfile
+import threading
 import time
+import zlib
 from getpass import getpass
 import configparser
 # WMF production wants the first, fedora uses the second
@@ -33,48 +54,493 @@ try:
     import MySQLdb
 except ImportError:
     pass
-
-KNOWN_ACTIONS = ['source', 'login', 'compare', 'gone', 'global']
+# only needed for zstd compressed output files
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_ACTIONS = ['source', 'login', 'compare', 'gone', 'global']
+KNOWN_ACTIONS = DEFAULT_ACTIONS + ['diff', 'export']
+# which actions must be done before the given one can start, if they are
+# to be run too; source and login are independent of everything else. gone
+# waits for login as well since they share the loginwiki connection
+ACTION_DEPENDENCIES = {'compare': ['source', 'login'],
+                       'gone': ['compare', 'login'],
+                       'global': ['gone']}
+# how much of a uids file to read at once when splitting it into shards
+SHARD_READ_BYTES = 1024 * 1024
+# output files that the diff action compares with those of an earlier run
+DIFF_STEMS = ['missing_uids', 'gone_uids', 'global_uids']
 # about 30 days worth of new user accounts for enwiki
 DEFAULT_UID_INTERVAL = 100
+# section info from the dblists, see load_section_index
+SECTION_INDEX = {}
+SECTION_INDEX_LOCK = threading.Lock()
+
+class RunStats():
+    '''
+    collect timings and counts for the queries run and the stages of
+    a run, for the --stats report; queries are grouped by stage and
+    wiki db, with a histogram of their latencies
+    '''
+    # upper bounds in seconds of the query latency histogram buckets
+    LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.queries = {}
+        self.stages = {}
+        self.plans = {}
+        self.handler_reads = {}
+
+    def record_query(self, stage, wikidb, execute_seconds, fetch_seconds=0.0, rows=0, nbytes=0):
+        '''
+        add the numbers for one query: how long the server took to start
+        sending results, how long fetching them took, and how many rows
+        and bytes of fields came back
+        '''
+        key = f"{stage}/{wikidb}"
+        latency = execute_seconds + fetch_seconds
+        with self.lock:
+            entry = self.queries.get(key)
+            if not entry:
+                entry = {'count': 0, 'execute_seconds': 0.0, 'fetch_seconds': 0.0,
+                         'max_seconds': 0.0, 'rows': 0, 'bytes': 0,
+                         'histogram': [0] * (len(self.LATENCY_BUCKETS) + 1)}
+                self.queries[key] = entry
+            entry['count'] += 1
+            entry['execute_seconds'] += execute_seconds
+            entry['fetch_seconds'] += fetch_seconds
+            entry['max_seconds'] = max(entry['max_seconds'], latency)
+            entry['rows'] += rows
+            entry['bytes'] += nbytes
+            entry['histogram'][bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+
+    def record_plan(self, stage, wikidb, shape, plan, full_scans):
+        '''
+        keep the EXPLAIN output for a query shape, with the tables it
+        would read all of, see QueryRunner.check_query_plan
+        '''
+        with self.lock:
+            self.plans.setdefault(f"{stage}/{wikidb}", {})[shape] = {
+                'plan': plan, 'full_scans': full_scans}
+
+    def record_handler_reads(self, stage, wikidb, shape, reads, rows):
+        '''
+        add the number of rows the server read (the change in its Handler_read_*
+        counters) to run one batch query of the given shape, and the number of
+        rows it sent back; the worst batch is kept too, so that a shape that
+        reads many rows for each one it returns stands out
+        '''
+        with self.lock:
+            entry = self.handler_reads.setdefault(f"{stage}/{wikidb}", {}).get(shape)
+            if not entry:
+                entry = {'batches': 0, 'reads': 0, 'rows': 0, 'max_reads': 0,
+                         'max_reads_per_row': 0.0}
+                self.handler_reads[f"{stage}/{wikidb}"][shape] = entry
+            entry['batches'] += 1
+            entry['reads'] += reads
+            entry['rows'] += rows
+            entry['max_reads'] = max(entry['max_reads'], reads)
+            entry['max_reads_per_row'] = max(entry['max_reads_per_row'], reads / max(rows, 1))
+
+    def add(self, stage, **counters):
+        '''
+        add to the named counters (seconds, rows, decode_seconds and so on) for a stage
+        '''
+        with self.lock:
+            entry = self.stages.setdefault(stage, {})
+            for name, value in counters.items():
+                entry[name] = entry.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timed(self, stage, counter='seconds'):
+        '''
+        add the time spent in the with block to the counter for the stage
+        '''
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, **{counter: time.monotonic() - started})
+
+    @staticmethod
+    def count_bytes(rows):
+        '''
+        return the number of bytes in the string fields of the rows, near enough
+        what came over the wire
+        '''
+        return sum(len(field) for row in rows for field in row
+                   if isinstance(field, (bytes, bytearray, str)))
+
+    def get_report(self):
+        '''
+        return everything collected as a dict, with rates worked out
+        '''
+        with self.lock:
+            queries = {key: dict(entry) for key, entry in self.queries.items()}
+            stages = {key: dict(entry) for key, entry in self.stages.items()}
+            plans = {key: dict(shapes) for key, shapes in self.plans.items()}
+            handler_reads = {key: {shape: dict(entry) for shape, entry in shapes.items()}
+                             for key, shapes in self.handler_reads.items()}
+        for entry in queries.values():
+            total = entry['execute_seconds'] + entry['fetch_seconds']
+            entry['mean_seconds'] = total / entry['count']
+            entry['rows_per_sec'] = entry['rows'] / total if total else None
+        for entry in stages.values():
+            if entry.get('seconds') and 'rows' in entry:
+                entry['rows_per_sec'] = entry['rows'] / entry['seconds']
+        return {
+            'elapsed_seconds': time.monotonic() - self.started,
+            'latency_buckets': self.LATENCY_BUCKETS + ['inf'],
+            'queries': queries,
+            'stages': stages,
+            'plans': plans,
+            'handler_reads': handler_reads,
+        }
+
+
+class BatchSizer():
+    '''
+    pick the size of each batch in a loop of batch queries
+
+    with a target time set, the size is scaled up or down after each
+    batch so that batches take about that long, staying between 1 and
+    maximum; without one, the size stays as it started
+    if the replica is more than max_lag seconds behind, or a batch took
+    more than twice the target time, the size is cut in half and we pause
+    before the next batch, for longer each time this happens in a row;
+    the pause shrinks away again once things are back to normal
+    '''
+    MAX_PAUSE = 60.0
+
+    def __init__(self, size, maximum, target=0.0, max_lag=0.0):
+        self.size = max(size, 1)
+        self.maximum = max(maximum, self.size)
+        self.target = target
+        self.max_lag = max_lag
+        self.pause = 0.0
+
+    def update(self, seconds, lag=None):
+        '''
+        adjust the batch size and pause given how long the last batch
+        took and how far behind the replica is (None if not known)
+        '''
+        lagging = self.max_lag and lag is not None and lag > self.max_lag
+        slow = self.target and seconds > 2 * self.target
+        if lagging or slow:
+            if self.target:
+                self.size = max(self.size // 2, 1)
+            self.pause = min(max(self.pause * 2, seconds, 1.0), self.MAX_PAUSE)
+            return
+
+        self.pause = self.pause / 2 if self.pause >= 0.5 else 0.0
+        if not self.target:
+            return
+        # don't swing too far on the basis of one batch
+        ratio = min(max(self.target / max(seconds, 0.001), 0.5), 2.0)
+        size = int(self.size * ratio)
+        if ratio > 1 and size == self.size:
+            size += 1
+        self.size = min(max(size, 1), self.maximum)
+
 
 class QueryRunner():
     '''
     munge and run queries on db servers for specific wikis
     '''
+    EXPLAIN_MODES = ['off', 'warn', 'refuse']
+    # EXPLAIN join types that mean every row of the table or its index is read
+    FULL_SCAN_TYPES = ['ALL', 'index']
+    # tables that may be read in full, the temporary table of names to look up
+    SMALL_TABLES = ['lookup_names']
+
     def __init__(self, dbconn, args):
         if not dbconn:
             raise ValueError("first arg dbconn cannot be None")
         self.dbconn = dbconn
         self.cursor = self.dbconn.conn.cursor()
         self.args = args
-
-    def run_query(self, query, sleep=0):
+        self.stats = args.get('stats') or RunStats()
+        # names known to be present, see get_name_index
+        self.name_index = None
+        # names looked up during this run, see split_known_names
+        self.name_cache = NameCache(int(self.dbconn.settings['main']['name_cache_size']))
+        # replica lag as last checked, see get_replica_lag
+        self.lag = None
+        self.lag_checked = None
+        self.lag_unavailable = False
+        self.explain = self.dbconn.settings['main']['explain_queries']
+        if self.explain not in self.EXPLAIN_MODES:
+            raise ValueError(f"bad explain_queries setting {self.explain}, "
+                             f"known are {self.EXPLAIN_MODES}")
+        # query shapes already explained, see check_query_plan
+        self.explained = set()
+        # only of use for the --stats report
+        self.handler_stats = (self.dbconn.settings['main'].getboolean('handler_stats') and
+                              self.args.get('show_stats', False))
+
+    def run_query(self, query, sleep=0, stage='other'):
         '''
         run a sql query, return all rows
         '''
         result = None
         if sleep:
             time.sleep(sleep)
+        self.check_query_plan(query, None, stage)
         try:
             if self.args['dryrun'] or self.args['verbose']:
                 print(f"query to be run on {self.dbconn.hostname} is", query)
             if self.args['dryrun']:
                 return None
-            self.cursor.execute(query.encode('utf-8'))
+            started = time.monotonic()
+            try:
+                self.cursor.execute(query.encode('utf-8'))
+            except MySQLdb.Error as ex:
+                if not is_connection_lost(ex):
+                    raise
+                self.reconnect()
+                started = time.monotonic()
+                self.cursor.execute(query.encode('utf-8'))
+            executed = time.monotonic()
             result = self.cursor.fetchall()
+            self.stats.record_query(stage, self.dbconn.wikidb, executed - started,
+                                    time.monotonic() - executed, len(result),
+                                    self.stats.count_bytes(result))
         except MySQLdb.Error as ex:
             raise MySQLdb.Error(
                 "exception running query on host "
-                f"{self.dbconn.hostname}, wiki {self.dbconn.wikidb} ({ex.args[0]}:{ex.args[1]})")
+                f"{self.dbconn.hostname}, wiki {self.dbconn.wikidb} ({db_error_text(ex)})")
         return result
 
-    def run_simple_query(self, query):
+    def reconnect(self):
+        '''
+        replace a connection the server has dropped (idle timeout,
+        restart) with a fresh one for the same wiki db
+        '''
+        if self.args['verbose']:
+            print(f"reconnecting to {self.dbconn.hostname} for {self.dbconn.wikidb}")
+        self.dbconn.reconnect()
+        self.cursor = self.dbconn.conn.cursor()
+        self.init_conn()
+
+    @staticmethod
+    def get_query_shape(query):
+        '''
+        return the query with lists of placeholders and numbers replaced,
+        so that the batches of one kind of query all look the same
+        '''
+        shape = re.sub(r"\((?:\s*(?:%s|\?)\s*,)*\s*(?:%s|\?)\s*\)", "(...)", query)
+        return re.sub(r"\b\d+\b", "N", shape)
+
+    def check_query_plan(self, query, params, stage):
+        '''
+        the first time a query of some shape is run, EXPLAIN it, keep the plan
+        for the stats report and, if it would read through a whole table
+        instead of going by an index, warn about it or refuse to run it, as
+        the explain_queries setting says
+        '''
+        if self.explain == 'off' or self.args['dryrun']:
+            return
+        shape = self.get_query_shape(query)
+        if shape in self.explained:
+            return
+        self.explained.add(shape)
+        cursor = self.dbconn.conn.cursor()
+        try:
+            self.execute_on(cursor, "EXPLAIN " + query, params)
+            columns = [column[0].lower() for column in cursor.description]
+            plan = [{column: value.decode('utf-8') if isinstance(value, bytes) else value
+                     for column, value in zip(columns, row)}
+                    for row in cursor.fetchall()]
+        except MySQLdb.Error as ex:
+            raise MySQLdb.Error(
+                "exception explaining query on host "
+                f"{self.dbconn.hostname}, wiki {self.dbconn.wikidb} ({db_error_text(ex)})")
+        finally:
+            cursor.close()
+        full_scans = [step['table'] for step in plan
+                      if step.get('type') in self.FULL_SCAN_TYPES and
+                      step.get('table') not in self.SMALL_TABLES]
+        self.stats.record_plan(stage, self.dbconn.wikidb, shape, plan, full_scans)
+        if not full_scans:
+            return
+        message = (f"query on {self.dbconn.hostname} for {self.dbconn.wikidb} would read all of "
+                   f"{', '.join(full_scans)}: {shape}")
+        if self.explain == 'refuse':
+            raise RuntimeError(f"refusing to run {message}")
+        sys.stderr.write(f"warning: {message}\n")
+
+    def get_handler_reads(self):
+        '''
+        return the sum of the session's Handler_read_* counters, which go up
+        for each row or index entry the server reads, or None if the
+        handler_stats setting is off or the counters can't be had
+        '''
+        if not self.handler_stats:
+            return None
+        try:
+            self.cursor.execute(b"SHOW SESSION STATUS LIKE 'Handler_read%';")
+            return sum(int(value) for _name, value in self.cursor.fetchall())
+        except MySQLdb.Error as ex:
+            if self.args['verbose']:
+                print(f"failed to get handler counters on {self.dbconn.hostname}, "
+                      f"not checking them again: {ex}")
+            self.handler_stats = False
+            return None
+
+    @staticmethod
+    def get_placeholder():
+        '''
+        return the placeholder for a query parameter for the db driver in use
+        '''
+        if getattr(MySQLdb, 'paramstyle', 'format') == 'qmark':
+            return "?"
+        return "%s"
+
+    @staticmethod
+    def execute_on(cursor, query, params=None):
+        '''
+        execute a query on the cursor, with parameters for its placeholders if any;
+        queries without parameters are sent as utf-8, while parameters are passed
+        to the driver as they are
+        '''
+        if params is None:
+            cursor.execute(query.encode('utf-8'))
+        else:
+            cursor.execute(query, params)
+
+    def run_statement(self, query, stage='other'):
+        '''
+        run a sql statement that doesn't return rows
+        '''
+        if self.args['dryrun'] or self.args['verbose']:
+            print(f"statement to be run on {self.dbconn.hostname} is", query)
+        if self.args['dryrun']:
+            return
+        started = time.monotonic()
+        try:
+            self.cursor.execute(query.encode('utf-8'))
+            self.stats.record_query(stage, self.dbconn.wikidb, time.monotonic() - started)
+        except MySQLdb.Error as ex:
+            raise MySQLdb.Error(
+                "exception running statement on host "
+                f"{self.dbconn.hostname}, wiki {self.dbconn.wikidb} ({db_error_text(ex)})")
+
+    def run_many(self, query, param_rows, stage='other'):
+        '''
+        run a sql statement once for each set of parameters, for statements
+        that don't return rows (inserts into temporary tables, for example)
+        '''
+        if self.args['dryrun'] or self.args['verbose']:
+            print(f"statement to be run on {self.dbconn.hostname} with "
+                  f"{len(param_rows)} sets of parameters is", query)
+        if self.args['dryrun']:
+            return
+        started = time.monotonic()
+        try:
+            self.cursor.executemany(query, param_rows)
+            self.stats.record_query(stage, self.dbconn.wikidb, time.monotonic() - started,
+                                    nbytes=self.stats.count_bytes(param_rows))
+        except MySQLdb.Error as ex:
+            raise MySQLdb.Error(
+                "exception running statement on host "
+                f"{self.dbconn.hostname}, wiki {self.dbconn.wikidb} ({db_error_text(ex)})")
+
+    def get_stream_cursor(self):
+        '''
+        get an unbuffered cursor, so that rows are handed to us by the
+        server as we fetch them instead of all being held in memory first
+        '''
+        sscursor = getattr(getattr(MySQLdb, 'cursors', None), 'SSCursor', None)
+        if sscursor:
+            return self.dbconn.conn.cursor(sscursor)
+        # the mariadb connector does it this way instead
+        return self.dbconn.conn.cursor(buffered=False)
+
+    def stream_query(self, query, chunksize=None, params=None, stage='other', sleep=0,
+                     restore=None):
+        '''
+        run a sql query on an unbuffered cursor, yielding lists of
+        at most chunksize rows as they are fetched
+        if params are given, they are passed to the driver to fill in
+        the placeholders in the query (see get_placeholder)
+        if sleep is given, wait that many seconds before running the query
+        if the connection has to be made again, restore, if given, is called
+        before the query is rerun, to set up whatever the query needs that
+        went away with the old connection (temporary tables, for example)
+        nothing else may be run on the connection until all the
+        rows have been read or the generator has been closed
+        '''
+        if not chunksize:
+            chunksize = int(self.dbconn.settings['main']['fetchsize'])
+        if sleep:
+            time.sleep(sleep)
+            self.stats.add(stage, throttle_seconds=sleep)
+        if self.args['dryrun'] or self.args['verbose']:
+            print(f"streaming query to be run on {self.dbconn.hostname} is", query)
+            if params:
+                print(f"with {len(params)} parameters")
+        if self.args['dryrun']:
+            return
+        self.check_query_plan(query, params, stage)
+        reads_before = self.get_handler_reads()
+        cursor = self.get_stream_cursor()
+        execute_seconds = 0.0
+        fetch_seconds = 0.0
+        rows_fetched = 0
+        bytes_fetched = 0
+        finished = False
+        try:
+            started = time.monotonic()
+            try:
+                self.execute_on(cursor, query, params)
+            except MySQLdb.Error as ex:
+                if not is_connection_lost(ex):
+                    raise
+                # nothing has been read yet so it's safe to just go again
+                cursor.close()
+                self.reconnect()
+                if restore:
+                    restore()
+                cursor = self.get_stream_cursor()
+                started = time.monotonic()
+                self.execute_on(cursor, query, params)
+            execute_seconds = time.monotonic() - started
+            while True:
+                started = time.monotonic()
+                rows = cursor.fetchmany(chunksize)
+                fetch_seconds += time.monotonic() - started
+                if not rows:
+                    break
+                rows_fetched += len(rows)
+                bytes_fetched += self.stats.count_bytes(rows)
+                yield rows
+            finished = True
+        except MySQLdb.Error as ex:
+            raise MySQLdb.Error(
+                "exception running query on host "
+                f"{self.dbconn.hostname}, wiki {self.dbconn.wikidb} ({db_error_text(ex)})")
+        finally:
+            cursor.close()
+            self.stats.record_query(stage, self.dbconn.wikidb, execute_seconds, fetch_seconds,
+                                    rows_fetched, bytes_fetched)
+        if finished and reads_before is not None:
+            reads_after = self.get_handler_reads()
+            # the counters start over if we had to reconnect
+            if reads_after is not None and reads_after >= reads_before:
+                self.stats.record_handler_reads(stage, self.dbconn.wikidb,
+                                                self.get_query_shape(query),
+                                                reads_after - reads_before, rows_fetched)
+
+    def run_simple_query(self, query, stage='other'):
         '''
         run query and return the output as a string
         this should be run only where the request is for one field's value from a single row
         '''
-        rows = self.run_query(query)
+        rows = self.run_query(query, stage=stage)
         if self.args['dryrun']:
             return None
 
@@ -87,13 +553,16 @@ class QueryRunner():
         '''
         set the database for queries
         '''
+        if self.dbconn.pool:
+            # the pool did this when it handed out the connection
+            return
         self.cursor.execute(f"use {self.dbconn.wikidb}")
 
     def get_max_uid(self):
         '''
         for a given wiki, return the max uid
         '''
-        result = self.run_simple_query('select max(user_id) from user;')
+        result = self.run_simple_query('select max(user_id) from user;', stage='max_uid')
         if self.args['dryrun']:
             # make something up
             return 20
@@ -115,61 +584,512 @@ class QueryRunner():
         start_uid = max(start_uid, 1)
         return { 'start': start_uid, 'end': end_uid }
 
-    def get_user_info(self, uids, outputpath):
+    def get_first_uid_since(self, timestamp, max_uid):
+        '''
+        return the smallest uid of a user registered at or after the timestamp
+        (yyyymmddhhmmss), or max_uid + 1 if there are none, by binary search
+        over the uids, looking at one user row per step
+        this counts on registration dates going up with uids, which is near
+        enough true; users with no registration date are from before it was
+        recorded, so they count as older than any timestamp
+        '''
+        low = 1
+        high = max_uid + 1
+        while low < high:
+            middle = (low + high) // 2
+            rows = self.run_query("SELECT user_id, user_registration FROM user "
+                                  f"WHERE user_id >= {middle} ORDER BY user_id LIMIT 1;",
+                                  stage='date_range')
+            if self.args['dryrun']:
+                # make something up
+                return middle
+            if not rows or (rows[0][1] and rows[0][1].decode('utf-8') >= timestamp):
+                high = middle
+            else:
+                # nobody in the gap up to the user we found either
+                low = min(int(rows[0][0]) + 1, high)
+        return low
+
+    def get_uid_range_for_dates(self, since, until):
+        '''
+        for a given wiki, return start and end uids covering the users
+        registered at or after since and before until (yyyymmddhhmmss
+        timestamps); if since is None, start from the first uid, and if
+        until is None, go up through the largest uid in the database
+        '''
+        max_uid = self.get_max_uid()
+        start_uid = self.get_first_uid_since(since, max_uid) if since else 1
+        end_uid = self.get_first_uid_since(until, max_uid) - 1 if until else max_uid
+        if self.args['dryrun'] or self.args['verbose']:
+            print(f"users on {self.dbconn.wikidb} registered from {since} to {until} "
+                  f"have uids {start_uid} to {end_uid}")
+        return {'start': start_uid, 'end': end_uid}
+
+    def get_replica_lag(self):
+        '''
+        return how many seconds the replica is behind its primary, as
+        SHOW SLAVE STATUS reports it, or None if we can't tell; the answer
+        is reused for lag_check_interval seconds before asking again
+        '''
+        if self.args['dryrun'] or self.lag_unavailable:
+            return None
+        now = time.monotonic()
+        interval = float(self.dbconn.settings['main']['lag_check_interval'])
+        if self.lag_checked is not None and now - self.lag_checked < interval:
+            return self.lag
+        self.lag_checked = now
+        try:
+            self.cursor.execute("SHOW SLAVE STATUS".encode('utf-8'))
+            rows = self.cursor.fetchall()
+            columns = [column[0] for column in self.cursor.description or []]
+        except MySQLdb.Error as ex:
+            if not is_connection_lost(ex):
+                # most likely we don't have the grant for it, so don't keep trying
+                if self.args['verbose']:
+                    print(f"can't check replica lag on {self.dbconn.hostname} "
+                          f"({db_error_text(ex)})")
+                self.lag_unavailable = True
+            return None
+        if 'Seconds_Behind_Master' not in columns:
+            self.lag = None
+            return None
+        # there is a row per replication channel; if the sql thread is
+        # stopped the value is NULL, but then nothing is changing anyways
+        lags = [row[columns.index('Seconds_Behind_Master')] for row in rows]
+        lags = [float(lag) for lag in lags if lag is not None]
+        self.lag = max(lags) if lags else None
+        return self.lag
+
+    def get_batch_sizer(self, size, maximum_setting):
+        '''
+        return a BatchSizer starting at the given batch size, with the maximum
+        from the named setting and the target time and replica lag limit from
+        the batch_target_seconds and max_replica_lag settings
+        '''
+        settings = self.dbconn.settings['main']
+        target = settings['batch_target_seconds']
+        max_lag = settings['max_replica_lag']
+        return BatchSizer(int(size), int(settings[maximum_setting]),
+                          float(target) if target else 0.0, float(max_lag) if max_lag else 0.0)
+
+    @staticmethod
+    def timed_chunks(stream, timing):
+        '''
+        pass along the chunks of rows from a stream_query generator, and when
+        it's done, append to timing the seconds spent getting them; this leaves
+        out the time our caller's consumer spends on the rows in between
+        '''
+        seconds = 0.0
+        while True:
+            started = time.monotonic()
+            rows = next(stream, None)
+            seconds += time.monotonic() - started
+            if rows is None:
+                break
+            yield rows
+        timing.append(seconds)
+
+    def adapt_batch(self, sizer, seconds, stage):
+        '''
+        let the batch sizer know how many seconds the last batch took,
+        counting the pause before it, and how far behind the replica is
+        '''
+        lag = self.get_replica_lag() if sizer.max_lag else None
+        size = sizer.size
+        sizer.update(max(seconds - sizer.pause, 0.0), lag)
+        self.stats.add(stage, batches=1)
+        if self.args['verbose'] and (sizer.size != size or sizer.pause):
+            print(f"{stage} batches on {self.dbconn.wikidb}: size {size} -> {sizer.size}, "
+                  f"pause {sizer.pause:.1f}s, replica lag {lag}")
+
+    def decode_user_row(self, row):
+        '''
+        convert a row of user info from the db into the fields
+        of a line in a uid file, as read_user_rows returns them
+        '''
+        if self.args['verbose']:
+            print("row:", row)
+        registration = row[1]
+        if not registration:
+            registration = 'NULL'
+        else:
+            registration = registration.decode('utf-8')
+        return [f"{row[0]},", f"{registration},", row[2].decode('utf-8')]
+
+    def decode_user_rows(self, rows):
+        '''
+        convert a list of rows of user info from the db as decode_user_row does
+        '''
+        with self.stats.timed('extract', 'decode_seconds'):
+            decoded = [self.decode_user_row(row) for row in rows]
+        self.stats.add('extract', rows=len(rows))
+        return decoded
+
+    def write_user_rows(self, rows, output):
+        '''
+        write user rows from the db to a UserRowsWriter, returning the
+        number of rows written and the last uid seen
+        '''
+        if not rows:
+            return 0, None
+        if output.binary:
+            # no need to turn everything into strings and back
+            with self.stats.timed('extract', 'decode_seconds'):
+                if self.args['verbose']:
+                    for row in rows:
+                        print("row:", row)
+                block = ([row[0] for row in rows],
+                         [int(row[1]) if row[1] else 0 for row in rows],
+                         [row[2].decode('utf-8') for row in rows])
+            self.stats.add('extract', rows=len(rows))
+            with self.stats.timed('extract', 'write_seconds'):
+                output.write_block(*block)
+        else:
+            decoded = self.decode_user_rows(rows)
+            with self.stats.timed('extract', 'write_seconds'):
+                output.write_rows(decoded)
+        return len(rows), rows[-1][0]
+
+    def open_rows_writer(self, outputpath, append=False):
+        '''
+        return a QueuedRowsWriter that writes user rows from the db to
+        the uids file with write_user_rows
+        '''
+        settings = self.dbconn.settings
+        return QueuedRowsWriter(self.write_user_rows, open_user_rows(outputpath, settings, append),
+                                int(settings['main']['write_queue_depth']))
+
+    def get_user_info(self, uids, output, sleep=0):
         '''
         get id, name and registration date for the users in the specified
-        uid range, write them to an output file, one row per line
+        uid range, and hand them to the QueuedRowsWriter to be written out
+        if sleep is given, wait that many seconds before running the query
         '''
         query = "SELECT user_id, user_registration, user_name FROM user "
         where = f"WHERE user_id >= {uids['start']} AND user_id < {uids['end']} "
         order = "ORDER BY user_id DESC;"
-        rows = self.run_query(query + where + order)
         if self.args['dryrun']:
+            self.run_query(query + where + order, sleep=sleep)
             return
-        with open(outputpath, "a", encoding="utf-8") as output:
-            for row in rows:
-                if self.args['dryrun'] or self.args['verbose']:
-                    print("row:", row)
-                uid = row[0]
-                registration = row[1]
-                if not registration:
-                    registration = 'NULL'
-                else:
-                    registration = registration.decode('utf-8')
-                name = row[2].decode('utf-8')
-                output.write(f"{uid}, {registration}, {name}\n")
-            output.close()
+        for rows in self.stream_query(query + where + order, stage='extract', sleep=sleep):
+            output.write(rows)
 
-    def get_user_batches(self, uids, outputpath, count):
+    def get_user_info_after(self, last_uid, end_uid, count, output, sleep=0):
         '''
-        get user info in batches of count size
+        get id, name and registration date for at most count users with uids
+        after last_uid and no larger than end_uid, in uid order, hand them
+        to the QueuedRowsWriter to be written out, and return the number of
+        rows and the last uid seen
+        if sleep is given, wait that many seconds before running the query
         '''
-        # create it once; the batch writes will append.
-        with open(outputpath, "w", encoding="utf-8") as output:
-            output.close()
+        query = "SELECT user_id, user_registration, user_name FROM user "
+        where = f"WHERE user_id > {last_uid} AND user_id <= {end_uid} "
+        order = f"ORDER BY user_id LIMIT {count};"
+        fetched = 0
+        for rows in self.stream_query(query + where + order, stage='extract', sleep=sleep):
+            output.write(rows)
+            fetched += len(rows)
+            last_uid = rows[-1][0]
+        return fetched, last_uid
+
+    def get_user_batches(self, uids, outputpath, count, checkpoint=None):
+        '''
+        get user info in batches of count size, or starting at that size
+        and adjusted as we go if batch_target_seconds is set (see BatchSizer)
+        if a checkpoint is passed, progress is recorded in it after each
+        batch, and an interrupted extraction of the same uid interval to
+        the same file picks up after the last batch recorded
+        rows are written out by a writer thread, while the next batch is fetched
+        '''
+        with self.stats.timed('extract'):
+            self.fetch_user_batches(uids, outputpath, count, checkpoint)
+
+    def fetch_user_batches(self, uids, outputpath, count, checkpoint=None):
+        '''
+        do the work of get_user_batches, without timing it for the
+        --stats report; for the pieces of a parallel extraction, which
+        is timed as a whole
+        '''
+        if self.dbconn.settings['main']['batch_mode'] == 'keyset':
+            self.get_user_batches_keyset(uids, outputpath, count, checkpoint)
+            return
+
+        done = checkpoint.begin_extract(uids, outputpath) if checkpoint else None
+        start = int(uids['start']) if done is None else done + 1
+        sizer = self.get_batch_sizer(count, 'batchsize_max')
+        end_uid = int(uids['end'])
+        with self.open_rows_writer(outputpath, append=done is not None) as output:
+            while start <= end_uid:
+                end = min(start + sizer.size, end_uid + 1)
+                started = time.monotonic()
+                self.get_user_info({'start': start, 'end': end}, output, sleep=sizer.pause)
+                if checkpoint:
+                    output.call(checkpoint.commit_batch, end - 1, outputpath)
+                self.adapt_batch(sizer, time.monotonic() - started, 'extract')
+                start = end
+
+    def get_user_batches_keyset(self, uids, outputpath, count, checkpoint=None):
+        '''
+        get user info in batches of count rows, each batch picking up
+        after the last uid of the previous one, so that gaps in the uid
+        space cost nothing; rows are written in ascending uid order
+        '''
+        done = checkpoint.begin_extract(uids, outputpath) if checkpoint else None
+        last_uid = int(uids['start']) - 1 if done is None else done
+        end_uid = int(uids['end'])
+        sizer = self.get_batch_sizer(count, 'batchsize_max')
+        with self.open_rows_writer(outputpath, append=done is not None) as output:
+            while last_uid < end_uid:
+                size = sizer.size
+                started = time.monotonic()
+                fetched, last_uid = self.get_user_info_after(last_uid, end_uid, size, output,
+                                                             sleep=sizer.pause)
+                if fetched < size:
+                    last_uid = end_uid
+                if checkpoint:
+                    output.call(checkpoint.commit_batch, last_uid, outputpath)
+                if fetched < size:
+                    break
+                self.adapt_batch(sizer, time.monotonic() - started, 'extract')
+
+    def iter_user_batches(self, uids, count):
+        '''
+        get user info in batches of count size as get_user_batches does,
+        but yield the rows, in the form read_user_rows gives them, instead
+        of writing them to a file
+        '''
+        query = "SELECT user_id, user_registration, user_name FROM user "
+        sizer = self.get_batch_sizer(count, 'batchsize_max')
+        timing = []
+        end_uid = int(uids['end'])
+        if self.dbconn.settings['main']['batch_mode'] == 'keyset':
+            last_uid = int(uids['start']) - 1
+            while last_uid < end_uid:
+                size = sizer.size
+                where = f"WHERE user_id > {last_uid} AND user_id <= {end_uid} "
+                order = f"ORDER BY user_id LIMIT {size};"
+                fetched = 0
+                stream = self.stream_query(query + where + order, stage='extract',
+                                           sleep=sizer.pause)
+                for rows in self.timed_chunks(stream, timing):
+                    fetched += len(rows)
+                    last_uid = rows[-1][0]
+                    yield from self.decode_user_rows(rows)
+                if fetched < size:
+                    break
+                self.adapt_batch(sizer, timing.pop(), 'extract')
+            return
 
         start = int(uids['start'])
-        end = start + count
-        if end > int(uids['end']):
-            end = int(uids['end']) + 1
-        while start < end:
-            self.get_user_info({'start': start, 'end': end}, outputpath)
-            if end > uids['end']:
-                break
-            start += count
-            end += count
-            if end > uids['end']:
-                end = uids['end'] + 1
+        while start <= end_uid:
+            end = min(start + sizer.size, end_uid + 1)
+            where = f"WHERE user_id >= {start} AND user_id < {end} "
+            order = "ORDER BY user_id DESC;"
+            stream = self.stream_query(query + where + order, stage='extract', sleep=sizer.pause)
+            for rows in self.timed_chunks(stream, timing):
+                yield from self.decode_user_rows(rows)
+            self.adapt_batch(sizer, timing.pop(), 'extract')
+            start = end
+
+    @staticmethod
+    def split_uid_range(uids, count, parts):
+        '''
+        split a uid interval into at most parts consecutive sub-intervals,
+        each covering a whole number of batches of count uids, so that
+        walking them in order gives the same batches as walking the
+        whole interval
+        '''
+        start = int(uids['start'])
+        end = int(uids['end'])
+        batches = (end - start + count) // count
+        batches_per_part = max((batches + parts - 1) // parts, 1)
+        subranges = []
+        while start <= end:
+            sub_end = min(start + batches_per_part * count - 1, end)
+            subranges.append({'start': start, 'end': sub_end})
+            start = sub_end + 1
+        return subranges
+
+    def get_user_batches_on_new_conn(self, uids, outputpath, count):
+        '''
+        get user info in batches of count size, using a db connection
+        of our own rather than the one this query runner uses
+        '''
+        dbconn = self.dbconn.clone()
+        dbconn.get_conn()
+        try:
+            queries = QueryRunner(dbconn, self.args)
+            queries.init_conn()
+            queries.fetch_user_batches(uids, outputpath, count)
+        finally:
+            dbconn.close()
+
+    def get_user_batches_parallel(self, uids, outputpath, count, workers, checkpoint=None):
+        '''
+        get user info in batches of count size, splitting the uid interval
+        up into one piece per worker and fetching each on its own connection
+        at the same time; the pieces are then put together into the output
+        file in the same order that get_user_batches would write them
+        if a checkpoint is passed, it is updated only once all the pieces
+        are done, so an interrupted run starts the interval over
+        '''
+        with self.stats.timed('extract'):
+            if checkpoint and checkpoint.begin_extract(uids, outputpath) == int(uids['end']):
+                return
+            subranges = self.split_uid_range(uids, count, workers)
+            outputdir = os.path.dirname(os.path.abspath(outputpath))
+            with tempfile.TemporaryDirectory(dir=outputdir) as tempdir:
+                parts = [os.path.join(tempdir, f"part_{i}") for i in range(len(subranges))]
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                    fetches = [pool.submit(self.get_user_batches_on_new_conn, subrange, part, count)
+                               for subrange, part in zip(subranges, parts)]
+                    for fetch in fetches:
+                        fetch.result()
+
+                # this works for binary uids files too, see UserRowsWriter
+                with open(outputpath, "wb") as output:
+                    for part in parts:
+                        if not os.path.exists(part):
+                            # dryrun
+                            continue
+                        with open(part, "rb") as part_input:
+                            shutil.copyfileobj(part_input, output)
+                    output.close()
+            if checkpoint:
+                checkpoint.commit_batch(int(uids['end']), outputpath)
+
+    def get_name_index(self):
+        '''
+        return the NameIndex for this wiki db, or None if the name_index_dir
+        setting is blank
+        '''
+        index_dir = self.dbconn.settings['main']['name_index_dir']
+        if not index_dir:
+            return None
+        if not self.name_index:
+            if not self.args['dryrun']:
+                os.makedirs(index_dir, exist_ok=True)
+            self.name_index = NameIndex(index_dir, self.dbconn.wikidb, self.args['dryrun'])
+        return self.name_index
+
+    def split_known_names(self, batch, stage, use_index=True):
+        '''
+        return a dict of the names in the batch of rows already known to be
+        present, with the entry found for each, and the list of the names
+        that need to be looked up
+        names looked up earlier in the run, for this or another source wiki,
+        are answered from the name cache, whether they were found or not;
+        if use_index is set, the name index is checked for the rest, and the
+        entries for names known from it are None
+        '''
+        known = {}
+        lookup = []
+        name_index = self.get_name_index() if use_index else None
+        cache_hits = index_hits = 0
+        for row in batch:
+            name = row[2]
+            if name in self.name_cache:
+                cache_hits += 1
+                entry = self.name_cache.get(name)
+                if entry is not None:
+                    known[name] = entry
+            elif name_index and name_index.contains(name):
+                index_hits += 1
+                known[name] = None
+            else:
+                lookup.append(name)
+        self.stats.add(stage, cache_hits=cache_hits)
+        if name_index:
+            self.stats.add(stage, index_hits=index_hits)
+        return known, lookup
 
-    def prep_name_for_query(self, field):
+    def save_found_names(self, lookup, found, use_index=True):
         '''
-        do the minimum we can to make user name
-        usable in an sql query; backslashes are still no go though
+        record the results of looking up the names: found is a dict of
+        the names that were found and their entries, these are added to
+        the name index, if there is one and use_index is set, and every
+        name goes into the name cache
         '''
-        if "'" in field:
-            field = field.replace("'", "''")
-        return "'" + field + "'"
+        if self.args['dryrun']:
+            return
+        for name in lookup:
+            self.name_cache.add(name, found.get(name))
+        if use_index and self.get_name_index():
+            self.name_index.add(found)
+
+    def save_name_index(self):
+        '''
+        merge the names found during the run into the name index, if there
+        is one; this rewrites the whole index, so it is done just once, at
+        the end of the run
+        '''
+        if self.name_index:
+            self.name_index.save()
+
+    def lookup_names(self, select, name_column, names, stage='other', sleep=0):
+        '''
+        run the select (with no WHERE clause) restricted to rows where
+        name_column is one of the names, yielding lists of rows as they
+        are fetched
+        the names are passed to the driver as query parameters, so they
+        need no escaping; if there are at least lookup_temp_table_min
+        of them, they are loaded into a temporary table instead which
+        the select is joined against
+        if sleep is given, wait that many seconds before running the select
+        '''
+        names = sorted(set(names))
+        if not names:
+            return
+        params = [name.encode('utf-8') for name in names]
+        if len(names) < int(self.dbconn.settings['main']['lookup_temp_table_min']):
+            placeholders = ",".join([self.get_placeholder()] * len(params))
+            yield from self.stream_query(f"{select} WHERE {name_column} IN ({placeholders});",
+                                         params=params, stage=stage, sleep=sleep)
+            return
+
+        # temporary tables are allowed even on read-only replicas, and
+        # go away by themselves with the connection, so if that has to be
+        # made again, the table is loaded again too
+        def load_names():
+            self.run_statement("CREATE TEMPORARY TABLE IF NOT EXISTS lookup_names "
+                               "(name VARBINARY(255) NOT NULL PRIMARY KEY);", stage=stage)
+            self.run_statement("DELETE FROM lookup_names;", stage=stage)
+            self.run_many(f"INSERT INTO lookup_names (name) VALUES ({self.get_placeholder()});",
+                          [(param,) for param in params], stage=stage)
+
+        load_names()
+        yield from self.stream_query(
+            f"{select} JOIN lookup_names ON {name_column} = lookup_names.name;", stage=stage,
+            sleep=sleep, restore=load_names)
+
+    def filter_missing_names(self, rows):
+        '''
+        check the rows, in batches, to see if any of their names are
+        in the user table, and yield those which are not; names the
+        name index knows about are not looked up again
+        '''
+        sizer = self.get_batch_sizer(self.dbconn.settings['main']['lookup_batchsize'],
+                                     'lookup_batchsize_max')
+        for batch in sized_batches(rows, sizer):
+            found_names, lookup = self.split_known_names(batch, 'gone')
+            found = {}
+            started = time.monotonic()
+            for found_batch in self.lookup_names("SELECT user_name FROM user", "user_name",
+                                                 lookup, stage='gone', sleep=sizer.pause):
+                with self.stats.timed('gone', 'decode_seconds'):
+                    found.update((name, (name,))
+                                 for name in (row[0].decode('utf-8') for row in found_batch))
+            if lookup:
+                self.adapt_batch(sizer, time.monotonic() - started, 'gone')
+            self.save_found_names(lookup, found)
+            found_names.update(found)
+            self.stats.add('gone', rows=len(batch), found=len(found_names))
+            if self.args['dryrun']:
+                continue
 
+            for gone in batch:
+                if gone[2] not in found_names:
+                    yield gone
     def check_missing_uids(self, uids_file, outputpath):
         '''
         check the uids in the missing uids file, in batches, to see if any
@@ -177,82 +1097,148 @@ class QueryRunner():
         been autocreated earlier from some other wiki than the one we used
         as the source wiki
         '''
-        # create it once; the batch writes will append.
-        with open(outputpath, "w", encoding="utf-8") as output:
-            output.close()
+        with self.stats.timed('gone'), \
+             open_user_rows(outputpath, self.dbconn.settings) as gone_out:
+            for batch in batched_rows(self.filter_missing_names(read_user_rows(uids_file)),
+                                      int(self.dbconn.settings['main']['fetchsize'])):
+                gone_out.write_rows(batch)
 
-        with open(uids_file, "r", encoding="utf-8") as uid_input:
-            content = uid_input.read()
-            uid_input.close()
-            entries = content.splitlines()
-            # format:  uid registr_date name
-            rows = [entry.split(' ',2) for entry in entries]
-            # names = [row[2] for row in rows]
-
-        select = "SELECT user_name FROM user WHERE user_name IN "
-        last = len(rows)
-        for i in range(0,last,50):
-            end = min(i + 50, last)
-            # skip names with '\' but we can manually check these later
-            where = ",".join([self.prep_name_for_query(row[2]) for row in rows[i:end]
-                              if "\\" not in row[2]])
-            query = f"{select} ({where});"
-            found_batch = self.run_query(query)
-            decoded_batch = [row[0].decode('utf-8').rstrip(',') for row in found_batch]
+    def filter_global_names(self, rows, present_out=None):
+        '''
+        check the rows, in batches, to see if any of their names are in
+        the global user table, and yield those which are not; the global
+        user entries that are found are written to present_out, if given
+        the name index is not used here, since it keeps only the names and
+        present_out needs the whole entry; names found earlier in the run
+        are written out from the name cache
+        '''
+        sizer = self.get_batch_sizer(self.dbconn.settings['main']['lookup_batchsize'],
+                                     'lookup_batchsize_max')
+        for batch in sized_batches(rows, sizer):
+            found_names, lookup = self.split_known_names(batch, 'global', use_index=False)
+            if present_out:
+                with self.stats.timed('global', 'write_seconds'):
+                    present_out.writelines(" ".join(entry) + "\n"
+                                           for entry in found_names.values())
+            found = {}
+            started = time.monotonic()
+            for found_batch in self.lookup_names(
+                    "SELECT gu_id, gu_registration, gu_name FROM globaluser", "gu_name",
+                    lookup, stage='global', sleep=sizer.pause):
+                with self.stats.timed('global', 'decode_seconds'):
+                    found_rows = [(str(row[0]), row[1].decode('utf-8'), row[2].decode('utf-8'))
+                                  for row in found_batch]
+                found.update((entry[2], entry) for entry in found_rows)
+                # also record separately the entries present in the global user
+                # table, the registration dates might be interesting
+                if present_out:
+                    with self.stats.timed('global', 'write_seconds'):
+                        present_out.writelines(" ".join(entry) + "\n" for entry in found_rows)
+            if lookup:
+                self.adapt_batch(sizer, time.monotonic() - started, 'global')
+            self.save_found_names(lookup, found, use_index=False)
+            found_names.update(found)
+            self.stats.add('global', rows=len(batch), found=len(found_names))
             if self.args['dryrun']:
                 continue
 
-            # this will include all names with \ in them too, we can live with that
-            really_missing = [row for row in rows[i:end] if row[2] not in decoded_batch]
-            with open(outputpath, "a", encoding="utf-8") as gone_out:
-                for gone in really_missing:
-                    gone_out.write(" ".join(gone) + "\n")
-
+            for global_missing in batch:
+                if global_missing[2] not in found_names:
+                    yield global_missing
     def check_global_users(self, uids_file, outputpath):
         '''
         check the uids in the gone uids file, in batches, to see if any
         of them are in the global user table, and write out those which
         are not.
         '''
-        # create them once; the batch writes will append.
-        with open(outputpath, "w", encoding="utf-8") as output:
-            output.close()
-        with open(outputpath + "_present", "w", encoding="utf-8") as output:
-            output.close()
+        self.check_global_rows(read_user_rows(uids_file), outputpath)
 
-        with open(uids_file, "r", encoding="utf-8") as uid_input:
-            content = uid_input.read()
-            uid_input.close()
-            entries = content.splitlines()
-            # format:  uid registr_date name
-            rows = [entry.split(' ',2) for entry in entries]
-            # names = [row[2] for row in rows]
-
-        select = "SELECT gu_id, gu_registration, gu_name FROM globaluser WHERE gu_name IN "
-        last = len(rows)
-        for i in range(0,last,50):
-            end = min(i + 50, last)
-            # skip names with '\' but we can manually check these later
-            where = ",".join([self.prep_name_for_query(row[2]) for row in rows[i:end]
-                              if "\\" not in row[2]])
-            query = f"{select} ({where});"
-            found_batch = self.run_query(query)
-            if self.args['dryrun']:
-                continue
-            decoded_batch = [(str(row[0]), row[1].decode('utf-8'), row[2].decode('utf-8')) for row in found_batch]
-            decoded_names = [row[2] for row in decoded_batch]
+    def check_global_rows(self, rows, outputpath):
+        '''
+        check the rows, in batches, against the global user table, and
+        write out those which are not in it
+        '''
+        with self.stats.timed('global'), \
+             open_user_rows(outputpath, self.dbconn.settings) as global_out, \
+             open_text_output(outputpath + "_present", self.dbconn.settings) as present_out:
+            for batch in batched_rows(self.filter_global_names(rows, present_out),
+                                      int(self.dbconn.settings['main']['fetchsize'])):
+                global_out.write_rows(batch)
+
+
+def check_gone_and_global(login_queries, global_queries, uids_file, gone_output,
+                          global_output):
+    '''
+    run the gone and global checks together: each batch of the entries in the
+    missing uids file that is not found on loginwiki is written to the gone
+    uids file and handed over to a thread that checks it against the global
+    user table, while the next batch is looked up on loginwiki
+    '''
+    settings = login_queries.dbconn.settings
+    handoff = queue.Queue(maxsize=int(settings['main']['write_queue_depth']))
+
+    def handed_over_rows():
+        for batch in iter(handoff.get, None):
+            yield from batch
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        global_check = pool.submit(global_queries.check_global_rows, handed_over_rows(),
+                                   global_output)
+        try:
+            with login_queries.stats.timed('gone'), \
+                 open_user_rows(gone_output, settings) as gone_out:
+                for batch in batched_rows(
+                        login_queries.filter_missing_names(read_user_rows(uids_file)),
+                        int(settings['main']['fetchsize'])):
+                    gone_out.write_rows(batch)
+                    hand_over(handoff, batch, global_check)
+        finally:
+            hand_over(handoff, None, global_check)
+        global_check.result()
+
+
+def hand_over(handoff, item, consumer):
+    '''
+    put the item on the queue for the consumer, unless the consumer has
+    stopped, in which case its error is raised, if it had one
+    '''
+    while True:
+        try:
+            handoff.put(item, timeout=1)
+            return
+        except queue.Full:
+            if consumer.done():
+                consumer.result()
+                return
 
-            # this will include all names with \ in them too, we can live with that
-            gone = [row for row in rows[i:end] if row[2] not in decoded_names]
-            with open(outputpath, "a", encoding="utf-8") as global_out:
-                for global_missing in gone:
-                    global_out.write(" ".join(global_missing) + "\n")
 
-            # also record separately the entries present in the global user table,
-            # the registration dates might be interesting
-            with open(outputpath + "_present", "a", encoding="utf-8") as global_out:
-                for global_present in decoded_batch:
-                    global_out.write(" ".join(global_present) + "\n")
+def run_actions(tasks, verbose=False):
+    '''
+    run the tasks, a dict of action names and functions to call, each on
+    a thread of its own as soon as the ones it depends on among them are
+    done; if one of them fails, the ones already running are waited for,
+    no new ones are started and the error is raised
+    '''
+    done = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(tasks) or 1) as pool:
+        running = {}
+        while len(done) < len(tasks):
+            for action, task in tasks.items():
+                if action in done or action in running.values():
+                    continue
+                if all(dependency in done or dependency not in tasks
+                       for dependency in ACTION_DEPENDENCIES.get(action, [])):
+                    if verbose:
+                        print("starting", action)
+                    running[pool.submit(task)] = action
+            finished, _unfinished = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                action = running.pop(future)
+                future.result()
+                if verbose:
+                    print("finished", action)
+                done.add(action)
 
 
 def usage(message=None):
@@ -267,7 +1253,11 @@ def usage(message=None):
     usage_message = """
 Usage: python3 account_creation_check.py [--actions <item,item,item>] [--config <path>]
     [--loginwiki_uids <startid,endid>] [--sourcewiki <wikidbname>]
-    [--sourcewiki_uids <startid,endid>] [--outputdir <dir>] [--dryrun] [--verbose] [--help]
+    [--sourcewiki_uids <startid,endid>] [--since <date>] [--until <date>]
+    [--all-wikis] [--section <name,name...>]
+    [--incremental] [--watch] [--pipeline] [--diff-with <date>]
+    [--outputdir <dir>] [--parallel <num>] [--workers <num>]
+    [--stats] [--dryrun] [--verbose] [--help]
 
 This script determines the appropriate mariadb hostname for the specified wiki and for loginwiki,
     runs queries on each of them to retrieve the specified fields from the user table for the specified
@@ -278,8 +1268,22 @@ This script determines the appropriate mariadb hostname for the specified wiki a
 Arguments:
 
      --actions          (-a):  actions to run, separated by a comma
-                               possible choices: source, login, compare, gone, global
-                               default: source,login,compare,gone
+                               possible choices: source, login, compare, gone, global,
+                               diff, export
+                               diff compares the missing, gone and global uids files of
+                               the run with those of an earlier run (see --diff-with),
+                               writing the entries that are new to <name>_added_<date>
+                               and those no longer there to <name>_resolved_<date>;
+                               with the default uid intervals, which move forward from
+                               run to run, resolved also has the entries that have just
+                               dropped out of the interval. diff can't be used with
+                               --incremental or --watch, whose dated files only have
+                               the entries new to each run
+                               export writes a plain text copy, with .txt added to the
+                               name, of each output file of the run that is in the binary
+                               format or compressed (see the output_format and
+                               output_compression settings)
+                               default: source,login,compare,gone,global
      --config           (-c):  file containing config settings for this script, see sample
                                ac_config.ini.sample for more information
                                default: ac_config.ini in the current working directory
@@ -290,9 +1294,69 @@ Arguments:
      --sourcewiki       (-s):  name of wiki database
                                default: enwiki
      --source_uids      (-S):  default: largest uid - 100000, largest uid
+                               if more than one source wiki is checked, the same interval
+                               is used for all of them
+     --all-wikis        (-A):  check every wiki in the section dblists instead of just one
+                               source wiki; output files have the wiki name in them
+                               default: false
+     --section          (-X):  check every wiki in the specified sections (s1, s2 etc),
+                               separated by a comma, instead of just one source wiki
+                               default: none
+     --since            (-b):  look at source wiki and loginwiki users registered at or after
+                               this date, in the format yyyymmdd or yyyymmddhhmmss; the
+                               uid interval on each wiki is found from the user registration
+                               dates, and is used unless the uids are given explicitly.
+                               this can't be used with --incremental
+                               default: none
+     --until            (-e):  look at users registered before this date, in the same
+                               format as --since
+                               default: none
+     --incremental      (-i):  look only at source wiki accounts newer than the last uid
+                               checked by an earlier incremental run, and add the results
+                               to the *_cumulative output files; if the last run was
+                               interrupted, finish its extraction and checks first.
+                               progress is kept in a state file per wiki, see the
+                               state_dir setting
+                               default: false
+     --watch            (-w):  keep running, and every watch_interval seconds (see the
+                               sample config file) check whether there are source wiki
+                               accounts newer than the last uid checked; if there are, run
+                               the actions for just those, as with --incremental (which this
+                               implies). db connections are kept open between checks. the
+                               source and compare actions are required, and this can't be
+                               used with --source_uids
+                               default: false
+     --pipeline         (-P):  run the actions as one chain, passing the entries from each
+                               to the next without writing and rereading files in between;
+                               only the output files listed in the pipeline_outputs setting
+                               are written. the source, login and compare actions are
+                               required, and this can't be used with --all-wikis, --section,
+                               --incremental, --watch or --parallel
+                               default: false
+     --diff-with        (-D):  date (yyyymmdd) of the run whose output files the diff
+                               action compares with those of this run
+                               default: the latest earlier run with output files in the
+                               output directory
      --outputdir        (-o):  directory in which to write output files; this directory
                                must already exist, it will not be created
                                default: output subdirectory in current working directory
+     --parallel         (-p):  split each uid interval into this many pieces and fetch
+                               them at the same time, each over its own db connection
+                               default: 1
+     --workers          (-j):  for the compare action, split the source and login uids
+                               files by user name into this many shards and compare them
+                               in as many processes at once; the missing entries are
+                               written in the same order as without this. only used when
+                               checking a single source wiki; with --all-wikis or
+                               --section the loginwiki names are loaded into memory once
+                               and every source wiki is checked against them, whatever
+                               this and the compare_method setting say
+                               default: 1
+     --stats            (-t):  write a json report with query latency histograms, rows and
+                               bytes fetched, and time spent decoding and writing for each
+                               stage, to stats_<date>.json in the output directory; see
+                               also the explain_queries and handler_stats settings
+                               default: false
      --dryrun           (-d):  print commands that would be run instead of running them
                                default: false
      --verbose          (-v):  display progress information and commands as they are run
@@ -303,65 +1367,565 @@ Arguments:
     sys.exit(1)
 
 
-class DBConn():
+class UidCheckpoint():
     '''
-    manage a connection to some database
+    keep track, in a state file per wiki, of the highest uid whose user info
+    has been extracted and checked, so that the next run need only look at
+    newer accounts, and of how far an extraction in progress has got, so
+    that an interrupted run can pick up where it left off
     '''
-    def __init__(self, wikidb, user, password, settings):
-        self.wikidb = wikidb
-        self.dbcreds =  {'user': user, 'password': password}
-        self.settings = settings
-        self.conn = None
-        self.hostname = None
-        self.section_name = None
-        self.dbconfig = {}
+    def __init__(self, state_dir, wikidb, dryrun=False):
+        self.path = os.path.join(state_dir, f"{wikidb}.json")
+        self.dryrun = dryrun
+        self.state = {'checked': None, 'extract': None}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as state_in:
+                self.state.update(json.load(state_in))
+
+    def save(self):
+        '''
+        write out the state file, replacing the old one only once the new one is complete
+        '''
+        if self.dryrun:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as state_out:
+            json.dump(self.state, state_out)
+        os.replace(temp_path, self.path)
 
-    def get_db_section_info(self):
+    def get_pending(self):
         '''
-        read section-based db lists from flat files in a specific directory
-        we expect the filenames to be s1.dblist, s2.dblist and so on
-        each such file should have one wiki database name per line, with
-        no other content except possibly comments starting with #
+        return the details (start, end, output) of an extraction that was
+        started but whose entries have not all been checked, or None
         '''
-        section_names = glob.glob(os.path.join(self.settings['main']['dblists_dir'], "s*.dblist"))
-        for section in section_names:
-            section_name = os.path.basename(section).split(".")[0]
-            if not section_name[1:].isdigit():
-                # some other thing like "securepollglobal.dblist" etc
-                continue
-            with open(section, "r", encoding="utf-8") as dblist:
-                content = dblist.read()
-                entries = content.splitlines()
-                entries = [entry for entry in entries if not entry.startswith('#')]
-                self.dbconfig[section_name] = entries
-        return self.dbconfig
+        return self.state['extract']
 
-    def get_db_hostname(self):
+    def get_new_uids(self, queries, interval):
         '''
-        get the analytics hostname serving the wiki db
+        return the uid interval from just after the last uid checked up to
+        the current largest uid; if nothing has been checked yet, this is
+        the usual default interval
         '''
-        section_name = ""
-        dbs_by_section = self.get_db_section_info()
+        if self.state['checked'] is None:
+            return queries.get_uid_range(interval, -1)
+        return {'start': self.state['checked'] + 1, 'end': queries.get_max_uid()}
 
-        for section, dbs in dbs_by_section.items():
-            if self.wikidb in dbs:
-                section_name = section
-                break
-        if not section_name:
-            raise RuntimeError(f"failed to find section name for {self.wikidb}")
+    def has_new_uids(self, queries):
+        '''
+        return True if there is an extraction to finish, nothing has been
+        checked yet, or there are uids past the last one checked
+        '''
+        if self.state['extract'] or self.state['checked'] is None:
+            return True
+        return queries.get_max_uid() > self.state['checked']
 
-        self.section_name = section_name
-        return self.settings['main']['hostname_templ'].format(section=section_name)
+    def begin_extract(self, uids, outputpath):
+        '''
+        record the start of an extraction, unless it is an interrupted
+        extraction of the same interval to the same file; in that case
+        cut the output file back to what it held after the last batch
+        recorded and return the last uid of that batch
+        return None if the extraction is to start from the beginning
+        '''
+        pending = self.state['extract']
+        if (pending and pending['start'] == int(uids['start']) and
+                pending['end'] == int(uids['end']) and pending['output'] == outputpath and
+                pending['done'] is not None and os.path.exists(outputpath)):
+            if not self.dryrun:
+                with open(outputpath, "r+b") as output:
+                    output.truncate(pending['size'])
+            return pending['done']
+        self.state['extract'] = {'start': int(uids['start']), 'end': int(uids['end']),
+                                 'output': outputpath, 'done': None, 'size': 0}
+        self.save()
+        return None
+
+    def commit_batch(self, done_uid, outputpath):
+        '''
+        record that the extraction has written out everything up through done_uid
+        '''
+        self.state['extract']['done'] = done_uid
+        self.state['extract']['size'] = os.path.getsize(outputpath) if not self.dryrun else 0
+        self.save()
 
-    def get_db_host_port(self):
+    def finish_check(self):
         '''
-        given a wiki db name, get the hostname and port of the analytics
-        server that hosts it
+        record that all entries from the extraction have been checked
         '''
-        hostname = self.get_db_hostname()
-        if not self.section_name[0] == 's' and self.section_name[1:].isdigit():
-            raise ValueError(f"bad section name {self.section_name}")
-        section_number = int(self.section_name[1:])
+        if self.state['extract']:
+            self.state['checked'] = self.state['extract']['end']
+            self.state['extract'] = None
+        self.save()
+
+
+def append_to_cumulative(path, cumulative_path):
+    '''
+    add the contents of an output file from this run to the end
+    of a file that collects the results of all runs
+    '''
+    if not os.path.exists(path):
+        return
+    # this works for binary uids files too, see UserRowsWriter
+    with open(path, "rb") as run_input, open(cumulative_path, "ab") as cumulative_out:
+        shutil.copyfileobj(run_input, cumulative_out)
+
+
+def get_state_dir(args, settings):
+    '''
+    return the directory for uid checkpoint files, creating it if need be
+    '''
+    state_dir = settings['main']['state_dir'] or os.path.join(args['outputdir'], "state")
+    if not args['dryrun']:
+        os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+class NameCache():
+    '''
+    the results of the name lookups made during a run against one wiki db,
+    for at most maxsize names: the entry found for each name, or None if it
+    was not found. when several source wikis are checked, the same names
+    turn up in many of their missing uids files, and this lets each of them
+    be looked up only once; the names used least recently are dropped first
+    names are kept exactly as they are in the user table, which is already
+    the normalized form
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def get(self, name):
+        '''
+        return the entry for a name that is in the cache, marking it as used
+        '''
+        self.entries.move_to_end(name)
+        return self.entries[name]
+
+    def add(self, name, entry):
+        '''
+        record the entry (or None) for the name, dropping the least
+        recently used name if the cache is full
+        '''
+        if self.maxsize <= 0:
+            return
+        self.entries[name] = entry
+        self.entries.move_to_end(name)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class NameIndex():
+    '''
+    the names known to be in the user table of a wiki db, kept on disk so
+    that later runs of the gone check need not look them up again; only
+    names that were found are recorded, since a name that isn't there now
+    may well be there later
+
+    names are stored as sorted 64-bit hashes in <wikidb>.names, with a
+    bloom filter in <wikidb>.bloom that turns away most names not in the
+    index without a search; both files are memory mapped rather than read
+    in, and are in the byte order of the host that wrote them
+    two names with the same hash would be mixed up, but with 64 bits that
+    won't happen for any number of names a wiki has
+    '''
+    BLOOM_HASHES = 7
+    BLOOM_BITS_PER_NAME = 10
+
+    def __init__(self, index_dir, wikidb, dryrun=False):
+        self.keys_path = os.path.join(index_dir, f"{wikidb}.names")
+        self.bloom_path = os.path.join(index_dir, f"{wikidb}.bloom")
+        self.dryrun = dryrun
+        self.maps = []
+        self.keys = self.map_file(self.keys_path, 'Q')
+        self.bloom = self.map_file(self.bloom_path, 'B')
+        # hashes of names found during this run, not yet saved
+        self.added = set()
+
+    def map_file(self, path, typecode):
+        '''
+        memory map the file and return a view of it as an array of the given type
+        '''
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return memoryview(b'').cast(typecode)
+        with open(path, "rb") as index_input:
+            mapped = mmap.mmap(index_input.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        cast = view.cast(typecode)
+        self.maps.append((mapped, view, cast))
+        return cast
+
+    def unmap_files(self):
+        '''
+        let go of the memory mapped files
+        '''
+        for mapped, view, cast in self.maps:
+            cast.release()
+            view.release()
+            mapped.close()
+        self.maps = []
+
+    @staticmethod
+    def get_key(name):
+        '''
+        return the 64-bit hash of the name
+        '''
+        return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(),
+                              'little')
+
+    def get_bloom_bits(self, key, nbits):
+        '''
+        return the positions of the bloom filter bits for the hash of a name
+        '''
+        first = key & 0xffffffff
+        step = (key >> 32) | 1
+        return [(first + i * step) % nbits for i in range(self.BLOOM_HASHES)]
+
+    def contains(self, name):
+        '''
+        return True if the name is known to be present
+        '''
+        key = self.get_key(name)
+        if key in self.added:
+            return True
+        if not len(self.keys):
+            return False
+        nbits = len(self.bloom) * 8
+        if nbits and not all(self.bloom[bit >> 3] & (1 << (bit & 7))
+                             for bit in self.get_bloom_bits(key, nbits)):
+            return False
+        position = bisect.bisect_left(self.keys, key)
+        return position < len(self.keys) and self.keys[position] == key
+
+    def add(self, names):
+        '''
+        record names that were found to be present
+        '''
+        self.added.update(self.get_key(name) for name in names)
+
+    def save(self):
+        '''
+        merge the names found during this run into the index files,
+        replacing each only once the new one is complete
+        '''
+        if self.dryrun or not self.added:
+            return
+        keys = array.array('Q', (key for key, _group in itertools.groupby(
+            heapq.merge(self.keys, sorted(self.added)))))
+        nbits = max(len(keys) * self.BLOOM_BITS_PER_NAME, 8192)
+        bloom = bytearray((nbits + 7) // 8)
+        nbits = len(bloom) * 8
+        for key in keys:
+            for bit in self.get_bloom_bits(key, nbits):
+                bloom[bit >> 3] |= 1 << (bit & 7)
+
+        for path, contents in [(self.keys_path, keys.tobytes()), (self.bloom_path, bloom)]:
+            with open(path + ".tmp", "wb") as index_out:
+                index_out.write(contents)
+        self.unmap_files()
+        os.replace(self.keys_path + ".tmp", self.keys_path)
+        os.replace(self.bloom_path + ".tmp", self.bloom_path)
+        self.keys = self.map_file(self.keys_path, 'Q')
+        self.bloom = self.map_file(self.bloom_path, 'B')
+        self.added = set()
+
+
+def get_dblist_mtimes(dblists_dir):
+    '''
+    return a dict of the modification times of the section dblist files
+    (s1.dblist, s2.dblist and so on) in the directory, keyed by filename
+    '''
+    mtimes = {}
+    for section in glob.glob(os.path.join(dblists_dir, "s*.dblist")):
+        section_name = os.path.basename(section).split(".")[0]
+        if not section_name[1:].isdigit():
+            # some other thing like "securepollglobal.dblist" etc
+            continue
+        mtimes[os.path.basename(section)] = os.stat(section).st_mtime_ns
+    return mtimes
+
+
+def read_dblists(dblists_dir, filenames):
+    '''
+    read section-based db lists from flat files in a specific directory
+    we expect the filenames to be s1.dblist, s2.dblist and so on
+    each such file should have one wiki database name per line, with
+    no other content except possibly comments starting with #
+    return a dict of wiki db name lists keyed by section name
+    '''
+    sections = {}
+    for filename in sorted(filenames):
+        section_name = filename.split(".")[0]
+        with open(os.path.join(dblists_dir, filename), "r", encoding="utf-8") as dblist:
+            content = dblist.read()
+            entries = content.splitlines()
+            entries = [entry for entry in entries if not entry.startswith('#')]
+            sections[section_name] = entries
+    return sections
+
+
+def load_section_index(settings):
+    '''
+    return the section info for the wikis in the dblists directory, as a dict
+    with 'sections' (section name -> list of wiki db names) and 'wikis'
+    (wiki db name -> section name)
+    this is worked out only once per run (per check with --watch, see
+    refresh_section_index); it is also saved to the section_cache file,
+    which is used instead of reading all the dblists for as long as none
+    of them have been changed
+    '''
+    with SECTION_INDEX_LOCK:
+        if SECTION_INDEX:
+            return SECTION_INDEX
+
+        dblists_dir = settings['main']['dblists_dir']
+        cache_path = settings['main']['section_cache']
+        mtimes = get_dblist_mtimes(dblists_dir)
+        sections = None
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as cache_in:
+                    cached = json.load(cache_in)
+                if cached.get('dblists_dir') == dblists_dir and cached.get('mtimes') == mtimes:
+                    sections = cached['sections']
+            except (OSError, ValueError, KeyError):
+                # unreadable or old format, we'll just rebuild it
+                sections = None
+
+        if sections is None:
+            sections = read_dblists(dblists_dir, mtimes.keys())
+            if cache_path:
+                try:
+                    temp_path = cache_path + ".tmp"
+                    with open(temp_path, "w", encoding="utf-8") as cache_out:
+                        json.dump({'dblists_dir': dblists_dir, 'mtimes': mtimes,
+                                   'sections': sections}, cache_out)
+                    os.replace(temp_path, cache_path)
+                except OSError as ex:
+                    sys.stderr.write(f"failed to write section cache {cache_path}: {ex}\n")
+
+        SECTION_INDEX['mtimes'] = mtimes
+        SECTION_INDEX['sections'] = sections
+        SECTION_INDEX['wikis'] = {wiki: section for section, dbs in sections.items()
+                                  for wiki in dbs}
+        return SECTION_INDEX
+
+
+def refresh_section_index(settings):
+    '''
+    forget the section info worked out earlier if any of the dblists have
+    been added, removed or changed since, so that the next call to
+    load_section_index reads them again; for long running processes
+    '''
+    with SECTION_INDEX_LOCK:
+        if SECTION_INDEX and (SECTION_INDEX['mtimes'] !=
+                              get_dblist_mtimes(settings['main']['dblists_dir'])):
+            SECTION_INDEX.clear()
+
+
+def is_connection_lost(ex):
+    '''
+    return True if the db exception is the server having gone
+    away or the connection having dropped, False otherwise
+    '''
+    code = getattr(ex, 'errno', None)
+    if code is None and ex.args:
+        code = ex.args[0]
+    # CR_SERVER_GONE_ERROR, CR_SERVER_LOST
+    return code in (2006, 2013)
+
+
+def db_error_text(ex):
+    '''
+    return code:message for a db exception from the driver, or just
+    the message for one we raised ourselves with a single argument
+    (a failed reconnect, for example)
+    '''
+    if len(ex.args) >= 2:
+        return f"{ex.args[0]}:{ex.args[1]}"
+    return str(ex)
+
+
+class ConnectionPool():
+    '''
+    hand out db connections for any wiki db, one server (hostname, port)
+    at a time; connections given back are kept open for the next wiki
+    db on the same server, pinged now and then so they don't time out,
+    and replaced if the server has dropped them anyway
+    '''
+    def __init__(self, user, password, settings):
+        self.dbcreds = {'user': user, 'password': password}
+        self.max_idle = int(settings['main']['pool_max_idle'])
+        self.ping_after = int(settings['main']['pool_ping_after'])
+        # (hostname, port) -> list of (connection, time given back)
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.keepalive_thread = None
+
+    def connect(self, hostname, port):
+        '''
+        open and return a new connection to the server
+        '''
+        try:
+            return MySQLdb.connect(
+                host=hostname, port=port,
+                user=self.dbcreds['user'], passwd=self.dbcreds['password'])
+        except MySQLdb.Error as ex:
+            raise MySQLdb.Error(
+                "failed to connect to or get cursor from "
+                f"{hostname}:{port}, {db_error_text(ex)}")
+
+    @staticmethod
+    def is_alive(conn):
+        '''
+        return True if the server still answers on the connection
+        '''
+        try:
+            conn.ping()
+            return True
+        except MySQLdb.Error:
+            return False
+
+    @staticmethod
+    def discard(conn):
+        '''
+        close a connection we won't use again, never mind if that fails
+        '''
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+    def checkout(self, hostname, port, wikidb):
+        '''
+        return an idle connection to the server if there is one that
+        still works, or a new one otherwise, with wikidb as the default
+        database
+        '''
+        conn = None
+        idle_since = None
+        with self.lock:
+            idle = self.idle.get((hostname, port))
+            if idle:
+                conn, idle_since = idle.pop()
+        if conn and time.monotonic() - idle_since > self.ping_after and not self.is_alive(conn):
+            self.discard(conn)
+            conn = None
+        if not conn:
+            conn = self.connect(hostname, port)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"use {wikidb}")
+        except MySQLdb.Error as ex:
+            if not is_connection_lost(ex):
+                raise
+            self.discard(conn)
+            conn = self.connect(hostname, port)
+            cursor = conn.cursor()
+            cursor.execute(f"use {wikidb}")
+        cursor.close()
+        return conn
+
+    def checkin(self, hostname, port, conn):
+        '''
+        take back a connection that is no longer in use, keeping it
+        open if there aren't too many idle ones for the server already
+        '''
+        with self.lock:
+            idle = self.idle.setdefault((hostname, port), [])
+            if len(idle) < self.max_idle:
+                idle.append((conn, time.monotonic()))
+                return
+        self.discard(conn)
+
+    def keepalive(self):
+        '''
+        ping every connection that has been idle a while, dropping
+        the ones the server no longer answers on
+        '''
+        now = time.monotonic()
+        with self.lock:
+            to_check = []
+            for key, idle in self.idle.items():
+                stale = [entry for entry in idle if now - entry[1] > self.ping_after]
+                for entry in stale:
+                    idle.remove(entry)
+                to_check.extend((key, entry[0]) for entry in stale)
+        for key, conn in to_check:
+            if self.is_alive(conn):
+                with self.lock:
+                    self.idle.setdefault(key, []).append((conn, time.monotonic()))
+            else:
+                self.discard(conn)
+
+    def start_keepalive(self):
+        '''
+        keep idle connections alive from a background thread until close_all is called
+        '''
+        def keepalive_loop():
+            while not self.stopping.wait(self.ping_after):
+                self.keepalive()
+        self.keepalive_thread = threading.Thread(target=keepalive_loop, daemon=True)
+        self.keepalive_thread.start()
+
+    def close_all(self):
+        '''
+        stop the keepalive thread and close all idle connections
+        '''
+        self.stopping.set()
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, _idle_since in conns:
+                self.discard(conn)
+
+
+class DBConn():
+    '''
+    manage a connection to some database
+    '''
+    def __init__(self, wikidb, user, password, settings, pool=None):
+        self.wikidb = wikidb
+        self.dbcreds =  {'user': user, 'password': password}
+        self.settings = settings
+        self.pool = pool
+        self.conn = None
+        self.hostname = None
+        self.section_name = None
+        self.dbconfig = {}
+
+    def get_db_section_info(self):
+        '''
+        return a dict of the wiki db names served by each db section,
+        keyed by section name; see load_section_index for where these
+        come from
+        '''
+        self.dbconfig = load_section_index(self.settings)['sections']
+        return self.dbconfig
+
+    def get_db_hostname(self):
+        '''
+        get the analytics hostname serving the wiki db
+        '''
+        section_name = load_section_index(self.settings)['wikis'].get(self.wikidb)
+        if not section_name:
+            raise RuntimeError(f"failed to find section name for {self.wikidb}")
+
+        self.section_name = section_name
+        return self.settings['main']['hostname_templ'].format(section=section_name)
+
+    def get_db_host_port(self):
+        '''
+        given a wiki db name, get the hostname and port of the analytics
+        server that hosts it
+        '''
+        hostname = self.get_db_hostname()
+        if not self.section_name[0] == 's' and self.section_name[1:].isdigit():
+            raise ValueError(f"bad section name {self.section_name}")
+        section_number = int(self.section_name[1:])
         port = self.settings['main']['port']
         if port:
             port = int(port)
@@ -377,6 +1941,10 @@ class DBConn():
         if self.conn:
             return self.conn
         hostname, port = self.get_db_host_port()
+        if self.pool:
+            self.conn = self.pool.checkout(hostname, port, self.wikidb)
+            self.hostname = hostname
+            return self.conn
         try:
             dbconn = MySQLdb.connect(
                 host=hostname, port=port,
@@ -388,7 +1956,39 @@ class DBConn():
         except MySQLdb.Error as ex:
             raise MySQLdb.Error(
                 "failed to connect to or get cursor from "
-                f"{hostname}:{port}, {ex.args[0]}:{ex.args[1]}")
+                f"{hostname}:{port}, {db_error_text(ex)}")
+
+    def close(self):
+        '''
+        close the connection to the db if we have one, or give
+        it back to the pool if it came from there
+        '''
+        if self.conn:
+            if self.pool:
+                self.pool.checkin(*self.get_db_host_port(), self.conn)
+            else:
+                self.conn.close()
+            self.conn = None
+
+    def reconnect(self):
+        '''
+        throw away the current connection without reusing it, and get a new one
+        '''
+        if self.conn:
+            try:
+                self.conn.close()
+            except MySQLdb.Error:
+                pass
+            self.conn = None
+        return self.get_conn()
+
+    def clone(self):
+        '''
+        return a new, not yet connected, DBConn for the same wiki db
+        and credentials, for use from another thread
+        '''
+        return DBConn(self.wikidb, self.dbcreds['user'], self.dbcreds['password'], self.settings,
+                      self.pool)
 
 
 class OptHandler():
@@ -398,7 +1998,22 @@ class OptHandler():
     DBLISTS_PATH = "/srv/mediawiki-config/dblists"
     HOSTNAME_TEMPLATE = "{section}-analytics-replica.eqiad.wmnet"
     BATCHSIZE = "5"
+    FETCHSIZE = "1000"
+    WORKERS_PER_HOST = "2"
+    LOOKUP_BATCHSIZE = "500"
+    LOOKUP_TEMP_TABLE_MIN = "2000"
+    BATCHSIZE_MAX = "100000"
+    LOOKUP_BATCHSIZE_MAX = "10000"
+    LAG_CHECK_INTERVAL = "30"
+    WRITE_QUEUE_DEPTH = "8"
+    WATCH_INTERVAL = "300"
+    NAME_CACHE_SIZE = "100000"
+    POOL_MAX_IDLE = "4"
+    SECTION_CACHE = os.path.join(os.path.expanduser("~"), ".ac_section_cache.json")
+    POOL_PING_AFTER = "60"
     DEFAULT_DB_USER = 'root'
+    COMPARE_MAX_INDEX_MB = "512"
+    SORT_CHUNK_ROWS = "1000000"
 
     @staticmethod
     def get_opt_defaults():
@@ -407,7 +2022,7 @@ class OptHandler():
         '''
         args = {}
 
-        args['actions'] = KNOWN_ACTIONS
+        args['actions'] = DEFAULT_ACTIONS
 
         cwd = os.getcwd()
         args['config'] = os.path.join(cwd, "ac_config.ini")
@@ -416,6 +2031,18 @@ class OptHandler():
         args['sourcewiki'] = 'enwiki'
 
         args['outputdir'] = os.path.join(cwd, "output")
+        args['parallel'] = 1
+        args['workers'] = 1
+        args['all_wikis'] = False
+        args['incremental'] = False
+        args['watch'] = False
+        args['since'] = None
+        args['until'] = None
+        args['pipeline'] = False
+        args['diff_with'] = None
+        args['show_stats'] = False
+        args['stats'] = RunStats()
+        args['sections'] = []
 
         args['dryrun'] = False
         args['verbose'] = False
@@ -434,6 +2061,23 @@ class OptHandler():
             usage("bad value specified for uids argument")
         return {'start': int(fields[0]), 'end': int(fields[1])}
 
+    @staticmethod
+    def val_to_timestamp(val):
+        '''
+        convert yyyymmdd or yyyymmddhhmmss (dashes, colons, spaces and a T
+        between date and time are allowed) to a mediawiki timestamp
+        '''
+        timestamp = val
+        for separator in ['-', ':', ' ', 'T']:
+            timestamp = timestamp.replace(separator, '')
+        if len(timestamp) == 8:
+            timestamp += '000000'
+        try:
+            time.strptime(timestamp, "%Y%m%d%H%M%S")
+        except ValueError:
+            usage(f"bad date specified: {val}")
+        return timestamp
+
     @staticmethod
     def get_opt_values(options, args):
         '''
@@ -453,8 +2097,34 @@ class OptHandler():
                 args['sourcewiki'] = val
             elif opt in ["-S", "--source_uids"]:
                 args['source_uids'] = OptHandler.val_to_uids(val)
+            elif opt in ["-b", "--since"]:
+                args['since'] = OptHandler.val_to_timestamp(val)
+            elif opt in ["-e", "--until"]:
+                args['until'] = OptHandler.val_to_timestamp(val)
             elif opt in ["-o", "--outputdir"]:
                 args['outputdir'] = val
+            elif opt in ["-A", "--all-wikis"]:
+                args['all_wikis'] = True
+            elif opt in ["-X", "--section"]:
+                args['sections'].extend(val.split(","))
+            elif opt in ["-t", "--stats"]:
+                args['show_stats'] = True
+            elif opt in ["-P", "--pipeline"]:
+                args['pipeline'] = True
+            elif opt in ["-D", "--diff-with"]:
+                args['diff_with'] = OptHandler.val_to_timestamp(val)[:8]
+            elif opt in ["-i", "--incremental"]:
+                args['incremental'] = True
+            elif opt in ["-w", "--watch"]:
+                args['watch'] = True
+            elif opt in ["-j", "--workers"]:
+                if not val.isdigit() or not int(val):
+                    usage("workers argument must be a positive number")
+                args['workers'] = int(val)
+            elif opt in ["-p", "--parallel"]:
+                if not val.isdigit() or not int(val):
+                    usage("parallel argument must be a positive number")
+                args['parallel'] = int(val)
             elif opt in ["-d", "--dryrun"]:
                 args['dryrun'] = True
             elif opt in ["-v", "--verbose"]:
@@ -466,6 +2136,14 @@ class OptHandler():
 
         if not os.path.exists(args['outputdir']):
             usage(f"No such output path exists {args['outputdir']}")
+        if args['watch']:
+            if 'source_uids' in args:
+                usage("--watch can't be used with --source_uids")
+            args['incremental'] = True
+        if args['since'] and args['until'] and args['since'] >= args['until']:
+            usage("--since date must be before --until date")
+        if (args['since'] or args['until']) and args['incremental']:
+            usage("--since and --until can't be used with --incremental")
 
     @staticmethod
     def get_settings(path):
@@ -477,6 +2155,34 @@ class OptHandler():
                                'hostname_templ': OptHandler.HOSTNAME_TEMPLATE,
                                'port': '',
                                'batchsize': OptHandler.BATCHSIZE,
+                               'fetchsize': OptHandler.FETCHSIZE,
+                               'batch_mode': 'range',
+                               'batchsize_max': OptHandler.BATCHSIZE_MAX,
+                               'batch_target_seconds': '',
+                               'max_replica_lag': '',
+                               'lag_check_interval': OptHandler.LAG_CHECK_INTERVAL,
+                               'lookup_batchsize': OptHandler.LOOKUP_BATCHSIZE,
+                               'lookup_temp_table_min': OptHandler.LOOKUP_TEMP_TABLE_MIN,
+                               'lookup_batchsize_max': OptHandler.LOOKUP_BATCHSIZE_MAX,
+                               'workers_per_host': OptHandler.WORKERS_PER_HOST,
+                               'section_cache': OptHandler.SECTION_CACHE,
+                               'state_dir': '',
+                               'output_format': 'text',
+                               'write_queue_depth': OptHandler.WRITE_QUEUE_DEPTH,
+                               'output_compression': 'none',
+                               'output_compression_level': '',
+                               'name_index_dir': '',
+                               'name_cache_size': OptHandler.NAME_CACHE_SIZE,
+                               'explain_queries': 'off',
+                               'handler_stats': 'off',
+                               'pipeline_outputs': 'missing_uids,gone_uids,global_uids',
+                               'pool_max_idle': OptHandler.POOL_MAX_IDLE,
+                               'pool_ping_after': OptHandler.POOL_PING_AFTER,
+                               'compare_method': 'auto',
+                               'compare_max_index_mb': OptHandler.COMPARE_MAX_INDEX_MB,
+                               'sort_chunk_rows': OptHandler.SORT_CHUNK_ROWS,
+                               'watch_interval': OptHandler.WATCH_INTERVAL,
+                               'dbpassword_file': '',
                                'dbuser': OptHandler.DEFAULT_DB_USER}
 
         if not path:
@@ -493,7 +2199,1266 @@ class OptHandler():
         return settings
 
 
-def compare_user_info(source_uid_file, login_uid_file, missing_output):
+class WikiFleetScanner():
+    '''
+    check many source wikis in one run: extract the user info for all of
+    them concurrently, with a limit on how many run at once against any
+    one db section, then compare each against a single index of the
+    loginwiki names and run the gone and global checks for each
+    '''
+    def __init__(self, args, settings, dbcreds, date, pool=None):
+        self.args = args
+        self.settings = settings
+        self.dbcreds = dbcreds
+        self.pool = pool
+        self.date = date
+        self.workers_per_host = int(settings['main']['workers_per_host'])
+        self.wikis_by_section = self.get_source_wikis()
+        self.failed = set()
+        # wiki -> source uids file, which may be from an earlier run being resumed
+        self.source_outputs = {}
+        self.checkpoints = {}
+        if args['incremental']:
+            state_dir = get_state_dir(args, settings)
+            self.checkpoints = {wiki: UidCheckpoint(state_dir, wiki, args['dryrun'])
+                                for wiki in self.get_wikis()}
+
+    def get_source_wikis(self):
+        '''
+        return a dict of the source wikis to check, keyed by section name,
+        for either all sections or the ones requested; loginwiki and
+        centralauth are never checked as source wikis
+        '''
+        dbconn = DBConn(self.args['loginwiki'], self.dbcreds['user'],
+                        self.dbcreds['password'], self.settings)
+        dbs_by_section = dbconn.get_db_section_info()
+        if self.args['sections']:
+            unknown = [section for section in self.args['sections']
+                       if section not in dbs_by_section]
+            if unknown:
+                usage(f"Unknown section(s) specified: {','.join(unknown)}, "
+                      f"known are {','.join(sorted(dbs_by_section))}")
+            dbs_by_section = {section: dbs_by_section[section] for section in self.args['sections']}
+        skip = [self.args['loginwiki'], 'centralauth']
+        return {section: [db for db in dbs if db and db not in skip]
+                for section, dbs in dbs_by_section.items()}
+
+    def get_wikis(self):
+        '''
+        return a sorted list of the source wikis that have not failed so far
+        '''
+        return sorted(wiki for dbs in self.wikis_by_section.values() for wiki in dbs
+                      if wiki not in self.failed)
+
+    def has_new_users(self):
+        '''
+        return True if any of the source wikis has accounts newer than
+        the last uid checked, see UidCheckpoint.has_new_uids
+        '''
+        for wiki in self.get_wikis():
+            dbconn = DBConn(wiki, self.dbcreds['user'], self.dbcreds['password'], self.settings,
+                            self.pool)
+            dbconn.get_conn()
+            try:
+                queries = QueryRunner(dbconn, self.args)
+                queries.init_conn()
+                if self.checkpoints[wiki].has_new_uids(queries):
+                    return True
+            finally:
+                dbconn.close()
+        return False
+
+    def get_output_path(self, stem, wiki):
+        '''
+        return the path of the output file of the given kind for a source wiki
+        '''
+        return os.path.join(self.args['outputdir'], f"{stem}_{wiki}_{self.date}")
+
+    def extract_wiki(self, wiki, count):
+        '''
+        get the user info for the source uid interval for one wiki,
+        over a connection of its own
+        '''
+        dbconn = DBConn(wiki, self.dbcreds['user'], self.dbcreds['password'], self.settings,
+                        self.pool)
+        dbconn.get_conn()
+        try:
+            queries = QueryRunner(dbconn, self.args)
+            queries.init_conn()
+            checkpoint = self.checkpoints.get(wiki)
+            source_output = self.get_output_path("source_uids", wiki)
+            if checkpoint and 'source_uids' not in self.args and checkpoint.get_pending():
+                pending = checkpoint.get_pending()
+                uids = {'start': pending['start'], 'end': pending['end']}
+                source_output = pending['output']
+            elif checkpoint and 'source_uids' not in self.args:
+                uids = checkpoint.get_new_uids(queries, DEFAULT_UID_INTERVAL)
+            elif 'source_uids' not in self.args and (self.args['since'] or self.args['until']):
+                uids = queries.get_uid_range_for_dates(self.args['since'], self.args['until'])
+            elif 'source_uids' not in self.args:
+                uids = queries.get_uid_range(DEFAULT_UID_INTERVAL, -1)
+            else:
+                uids = dict(self.args['source_uids'])
+                if uids['end'] == -1:
+                    uids['end'] = queries.get_max_uid()
+            if self.args['dryrun'] or self.args['verbose']:
+                print(f"source uids for {wiki} is", uids)
+            self.source_outputs[wiki] = source_output
+            queries.get_user_batches(uids, source_output, count, checkpoint)
+        finally:
+            dbconn.close()
+
+    def extract_sources(self, count):
+        '''
+        get the user info for every source wiki, with at most workers_per_host
+        extractions running at once per db section; wikis for which this
+        fails are reported and left out of the rest of the run
+        '''
+        pools = []
+        extractions = {}
+        for dbs in self.wikis_by_section.values():
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers_per_host)
+            pools.append(pool)
+            for wiki in dbs:
+                extractions[pool.submit(self.extract_wiki, wiki, count)] = wiki
+        try:
+            for extraction in concurrent.futures.as_completed(extractions):
+                wiki = extractions[extraction]
+                try:
+                    extraction.result()
+                except (MySQLdb.Error, RuntimeError, OSError) as ex:
+                    sys.stderr.write(f"failed to get user info for {wiki}: {ex}\n")
+                    self.failed.add(wiki)
+        finally:
+            for pool in pools:
+                pool.shutdown()
+
+    def compare_sources(self, login_uid_file):
+        '''
+        load the loginwiki names once, then check the source entries for
+        each wiki against them; this is always the in-memory hash compare,
+        whatever the compare_method setting and --workers say
+        '''
+        comparer = UserInfoComparer(self.args, self.settings)
+        comparer.start_stats('index')
+        login_names = comparer.load_name_index(login_uid_file)
+        comparer.finish_stats("load loginwiki names", stage='compare_load')
+        for wiki in self.get_wikis():
+            source_output = self.source_outputs.get(wiki, self.get_output_path("source_uids", wiki))
+            if not os.path.exists(source_output):
+                sys.stderr.write(f"no source uids file for {wiki}, skipping\n")
+                self.failed.add(wiki)
+                continue
+            comparer.compare_with_index(source_output, login_names,
+                                        self.get_output_path("missing_uids", wiki),
+                                        label=f"compare {wiki}")
+
+    def check_missing(self, login_queries):
+        '''
+        for each source wiki, check the entries missing from the loginwiki
+        interval against the whole loginwiki user table
+        '''
+        for wiki in self.get_wikis():
+            login_queries.check_missing_uids(self.get_output_path("missing_uids", wiki),
+                                             self.get_output_path("gone_uids", wiki))
+
+    def check_global(self, global_queries):
+        '''
+        for each source wiki, check the entries not in the loginwiki user
+        table against the global user table
+        '''
+        for wiki in self.get_wikis():
+            global_queries.check_global_users(self.get_output_path("gone_uids", wiki),
+                                              self.get_output_path("global_uids", wiki))
+
+    def check_gone_and_global(self, login_queries, global_queries):
+        '''
+        for each source wiki, check the entries missing from the loginwiki
+        interval against the whole loginwiki user table, and those not found
+        there against the global user table, at the same time
+        '''
+        for wiki in self.get_wikis():
+            check_gone_and_global(login_queries, global_queries,
+                                  self.get_output_path("missing_uids", wiki),
+                                  self.get_output_path("gone_uids", wiki),
+                                  self.get_output_path("global_uids", wiki))
+
+    def finish_checks(self):
+        '''
+        for an incremental run, add each wiki's results to its cumulative
+        output files and record that its new entries have been checked
+        '''
+        for wiki in self.get_wikis():
+            checkpoint = self.checkpoints.get(wiki)
+            if not checkpoint:
+                continue
+            if not self.args['dryrun']:
+                for stem, action in [("missing_uids", 'compare'), ("gone_uids", 'gone'),
+                                     ("global_uids", 'global')]:
+                    if action not in self.args['actions']:
+                        continue
+                    append_to_cumulative(
+                        self.get_output_path(stem, wiki),
+                        os.path.join(self.args['outputdir'], f"{stem}_{wiki}_cumulative"))
+            checkpoint.finish_check()
+
+    def diff_outputs(self):
+        '''
+        for each source wiki, write out the entries added and resolved since
+        an earlier run, see diff_outputs
+        '''
+        diff_outputs([f"{stem}_{wiki}" for wiki in self.get_wikis() for stem in DIFF_STEMS],
+                     self.date, self.args, self.settings)
+
+    def export_outputs(self, login_uid_file):
+        '''
+        write out text copies of the output files for each source wiki and
+        of the login uids file, for those in the binary format
+        '''
+        paths = [login_uid_file]
+        for wiki in self.get_wikis():
+            paths.append(self.source_outputs.get(wiki, self.get_output_path("source_uids", wiki)))
+            paths.extend(self.get_output_path(stem, wiki)
+                         for stem in ["missing_uids", "gone_uids", "global_uids"])
+            paths.extend(get_diff_paths(self.args['outputdir'],
+                                        [f"{stem}_{wiki}" for stem in DIFF_STEMS], self.date))
+        export_outputs(paths, self.args)
+
+
+# start of each block of a binary uids file
+USER_ROWS_MAGIC = b"ACROWS01"
+USER_ROWS_HEADER = struct.Struct("=8sQQ")
+# start of compressed files
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSIONS = {'none': None, 'gzip': 6, 'zstd': 3}
+
+
+def get_compression(path):
+    '''
+    return 'gzip' or 'zstd' if the file is compressed that way, None otherwise
+    '''
+    with open(path, "rb") as infile:
+        start = infile.read(len(ZSTD_MAGIC))
+    if start.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if start == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+def open_input(path):
+    '''
+    open a file for reading as bytes, decompressing it as it is read
+    if it is gzip or zstd compressed
+    '''
+    compression = get_compression(path)
+    if compression == 'gzip':
+        return gzip.open(path, "rb")
+    if compression == 'zstd':
+        if not zstandard:
+            raise RuntimeError(f"{path} is zstd compressed but the zstandard module "
+                               "is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"),
+                                                          read_across_frames=True)
+    return open(path, "rb")
+
+
+def get_uncompressed_size(path, limit):
+    '''
+    return the size of the contents of the file once decompressed; for
+    a compressed file this means reading it through, so stop at and
+    return the first count over limit, if the file gets that far
+    '''
+    if not get_compression(path):
+        return os.path.getsize(path)
+    size = 0
+    with open_input(path) as infile:
+        while size <= limit:
+            data = infile.read(1024 * 1024)
+            if not data:
+                break
+            size += len(data)
+    return size
+
+
+def open_text_input(path):
+    '''
+    open a file for reading as utf-8 text, decompressing it if need be
+    '''
+    if not get_compression(path):
+        return open(path, "r", encoding="utf-8")
+    return io.TextIOWrapper(open_input(path), encoding="utf-8")
+
+
+def open_output(path, compression=None, level=None, append=False):
+    '''
+    open a file for writing bytes, compressing them with gzip or zstd
+    if asked; appending to a compressed file adds a new gzip member or
+    zstd frame, which is read back as though it were all one
+    '''
+    mode = "ab" if append else "wb"
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=level)
+    if compression == 'zstd':
+        if not zstandard:
+            raise RuntimeError("zstd compression needs the zstandard module")
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(path, mode))
+    return open(path, mode)
+
+
+def get_output_compression(settings):
+    '''
+    return the compression (None, 'gzip' or 'zstd') and compression level
+    for output files from the output_compression and output_compression_level
+    settings
+    '''
+    compression = settings['main']['output_compression']
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"bad output compression {compression}, "
+                         f"known are {', '.join(COMPRESSIONS)}")
+    if compression == 'none':
+        return None, None
+    level = settings['main']['output_compression_level']
+    return compression, int(level) if level else COMPRESSIONS[compression]
+
+
+def open_text_output(path, settings):
+    '''
+    open a file for writing utf-8 text, compressed as the settings say
+    '''
+    compression, level = get_output_compression(settings)
+    if not compression:
+        return open(path, "w", encoding="utf-8")
+    return io.TextIOWrapper(open_output(path, compression, level), encoding="utf-8")
+
+
+def parse_user_row(row):
+    '''
+    given the fields of an entry as read_user_rows returns them, return the
+    uid as an int, the registration date as an int (0 if there is none) and
+    the name; the uid and registration fields may or may not have the comma
+    after them, as entries from the global user table don't
+    '''
+    registration = row[1].rstrip(',')
+    return (int(row[0].rstrip(',')), int(registration) if registration != 'NULL' else 0,
+            row[2])
+
+
+def format_user_row(uid, registration, name):
+    '''
+    return the fields of an entry as read_user_rows does, given the uid,
+    registration date (0 if there is none) and name
+    '''
+    return [f"{uid},", f"{registration if registration else 'NULL'},", name]
+
+
+def is_binary_user_rows(path):
+    '''
+    return True if the uids file is in the binary format, see UserRowsWriter
+    '''
+    with open_input(path) as uid_input:
+        return uid_input.read(len(USER_ROWS_MAGIC)) == USER_ROWS_MAGIC
+
+
+class UserRowsWriter():
+    '''
+    write entries to a uids file, as text, one entry per line with the
+    fields separated by spaces, or in the binary format
+
+    a binary file is a series of blocks, each holding the entries from one
+    call to write_block (or write_rows): a header with USER_ROWS_MAGIC, the
+    number of entries and the size of the names, then a column of uids, a
+    column of registration dates as numbers (0 for none), a column of the
+    offsets of the names, and the names, newline terminated; everything is
+    in the byte order of the host and padded to 8 bytes
+    since every block stands on its own, files can be appended to, joined
+    together, and cut back to the end of any block
+
+    either format may be compressed with gzip or zstd; each flush ends
+    the gzip member or zstd frame being written, so that a file cut back
+    to its size after a flush can still be read
+    '''
+    def __init__(self, path, binary=False, append=False, compression=None, level=None):
+        self.path = path
+        self.binary = binary
+        self.compression = compression
+        self.level = level
+        self.output = open_output(path, compression, level, append)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_block(self, uids, registrations, names):
+        '''
+        write out entries given as a list of uids, a list of registration
+        dates as numbers (0 if there is none) and a list of names
+        '''
+        if not uids:
+            return
+        if not self.binary:
+            self.output.write("".join(" ".join(format_user_row(*entry)) + "\n"
+                                      for entry in zip(uids, registrations, names))
+                              .encode('utf-8'))
+            return
+        blob = "".join(name + "\n" for name in names).encode('utf-8')
+        offsets = array.array('Q', [0])
+        for name in names:
+            offsets.append(offsets[-1] + len(name.encode('utf-8')) + 1)
+        self.output.write(USER_ROWS_HEADER.pack(USER_ROWS_MAGIC, len(uids), len(blob)))
+        self.output.write(array.array('q', uids).tobytes())
+        self.output.write(array.array('Q', registrations).tobytes())
+        self.output.write(offsets.tobytes())
+        self.output.write(blob + b"\0" * (-len(blob) % 8))
+
+    def write_rows(self, rows):
+        '''
+        write out entries given as read_user_rows returns them
+        '''
+        if not rows:
+            return
+        if not self.binary:
+            self.output.write("".join(" ".join(row) + "\n" for row in rows).encode('utf-8'))
+            return
+        self.write_block(*zip(*[parse_user_row(row) for row in rows]))
+
+    def flush(self):
+        '''
+        push everything written so far out to the file
+        '''
+        if not self.compression:
+            self.output.flush()
+            return
+        self.output.close()
+        self.output = open_output(self.path, self.compression, self.level, append=True)
+
+    def close(self):
+        '''
+        close the file
+        '''
+        self.output.close()
+
+
+class QueuedRowsWriter():
+    '''
+    write rows to a UserRowsWriter from a thread of our own, so that
+    whoever is fetching the rows can go on to the next ones while these
+    are converted and written out; rows are handed over through a queue
+    of at most depth lists of rows, and are written by passing each list
+    and the UserRowsWriter to write_rows
+    if writing fails, the error is raised by the next call to write, call
+    or close, and anything left in the queue is dropped
+    '''
+    def __init__(self, write_rows, output, depth):
+        self.write_rows = write_rows
+        self.output = output
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(raise_error=exc_type is None)
+
+    def run(self):
+        '''
+        take lists of rows, and functions to call, off the queue until told to stop
+        '''
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            try:
+                if callable(item[0]):
+                    self.output.flush()
+                    item[0](*item[1:])
+                else:
+                    self.write_rows(item[0], self.output)
+            except Exception as ex:
+                # whatever it is, it goes back to the thread that queued the rows
+                self.error = ex
+
+    def check(self):
+        '''
+        raise the error the writer thread ran into, if there was one
+        '''
+        if self.error:
+            raise self.error
+
+    def write(self, rows):
+        '''
+        queue a list of rows to be written
+        '''
+        self.check()
+        self.queue.put((rows,))
+
+    def call(self, func, *args):
+        '''
+        once everything queued so far has been written and flushed to the
+        file, call func with args, from the writer thread
+        '''
+        self.check()
+        self.queue.put((func,) + args)
+
+    def close(self, raise_error=True):
+        '''
+        write out whatever is still queued and close the file
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        self.output.close()
+        if raise_error:
+            self.check()
+
+
+class UserRowsFile():
+    '''
+    read a uids file in the binary format by memory mapping it, giving
+    access to each block of entries as columns; compressed files can't be
+    mapped, so they are decompressed and read a block at a time instead
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.blocks = []
+        self.views = []
+        self.mapped = None
+        self.compressed = get_compression(path) is not None
+        if self.compressed or not os.path.getsize(path):
+            return
+        with open(path, "rb") as uid_input:
+            self.mapped = mmap.mmap(uid_input.fileno(), 0, access=mmap.ACCESS_READ)
+        position = 0
+        while position < len(self.mapped):
+            magic, count, names_size = USER_ROWS_HEADER.unpack_from(self.mapped, position)
+            if magic != USER_ROWS_MAGIC:
+                raise ValueError(f"bad block at offset {position} in binary uids file {path}")
+            position += USER_ROWS_HEADER.size
+            uids = self.get_column(position, count, 'q')
+            position += count * 8
+            registrations = self.get_column(position, count, 'Q')
+            position += count * 8
+            offsets = self.get_column(position, count + 1, 'Q')
+            position += (count + 1) * 8
+            if position + names_size > len(self.mapped):
+                raise ValueError(f"binary uids file {path} is cut off partway through a block")
+            self.blocks.append((uids, registrations, offsets, position, names_size))
+            position += names_size + (-names_size % 8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        if self.compressed:
+            return sum(len(block[0]) for block in self.read_blocks())
+        return sum(len(block[0]) for block in self.blocks)
+
+    def get_column(self, position, count, typecode):
+        '''
+        return a view of count numbers of the given type at the position in the file
+        '''
+        view = memoryview(self.mapped)[position:position + count * 8]
+        column = view.cast(typecode)
+        self.views.extend([column, view])
+        return column
+
+    def iter_blocks(self, first=0, last=None):
+        '''
+        yield the uids, registration dates (0 if there is none) and names
+        of each block of entries; the uids and dates are views of the file,
+        the names are decoded all at once into a list
+        if first or last are given, only the blocks numbered from first up
+        to but not including last are read; compressed files are read in full
+        '''
+        if self.compressed:
+            yield from self.read_blocks()
+            return
+        for uids, registrations, _offsets, position, names_size in self.blocks[first:last]:
+            names = self.mapped[position:position + names_size].decode('utf-8').split("\n")
+            yield uids, registrations, names[:-1]
+
+    def read_blocks(self):
+        '''
+        yield the uids, registration dates and names of each block of
+        entries as iter_blocks does, reading the file from start to end
+        '''
+        with open_input(self.path) as uid_input:
+            while True:
+                header = uid_input.read(USER_ROWS_HEADER.size)
+                if not header:
+                    return
+                magic, count, names_size = USER_ROWS_HEADER.unpack(header)
+                if magic != USER_ROWS_MAGIC:
+                    raise ValueError(f"bad block in binary uids file {self.path}")
+                columns = uid_input.read((3 * count + 1) * 8)
+                names = uid_input.read(names_size + (-names_size % 8))
+                if len(names) < names_size:
+                    raise ValueError(f"binary uids file {self.path} is cut off "
+                                     "partway through a block")
+                uids = array.array('q', columns[:count * 8])
+                registrations = array.array('Q', columns[count * 8:count * 16])
+                yield uids, registrations, names[:names_size].decode('utf-8').split("\n")[:-1]
+
+    def iter_rows(self):
+        '''
+        yield each entry as read_user_rows does
+        '''
+        for uids, registrations, names in self.iter_blocks():
+            yield from map(format_user_row, uids, registrations, names)
+
+    def close(self):
+        '''
+        let go of the memory mapped file
+        '''
+        for view in self.views:
+            view.release()
+        self.views = []
+        if self.mapped:
+            self.mapped.close()
+            self.mapped = None
+
+
+def open_user_rows(path, settings, append=False):
+    '''
+    return a UserRowsWriter for the uids file, writing in the format and
+    with the compression given by the output_format and output_compression
+    settings
+    '''
+    output_format = settings['main']['output_format']
+    if output_format not in ['text', 'binary']:
+        raise ValueError(f"bad output format {output_format}, known are text, binary")
+    return UserRowsWriter(path, output_format == 'binary', append,
+                          *get_output_compression(settings))
+
+
+def read_user_rows(path):
+    '''
+    read the entries of a uid file one at a time, yielding each entry
+    split into uid, registration and name fields; text files are read
+    one line at a time, binary files are memory mapped, and compressed
+    files of either sort are decompressed as they are read
+    '''
+    if is_binary_user_rows(path):
+        with UserRowsFile(path) as rows_file:
+            yield from rows_file.iter_rows()
+        return
+    with open_text_input(path) as uid_input:
+        for entry in uid_input:
+            entry = entry.rstrip('\n')
+            if not entry:
+                continue
+            # format:  uid, registr_date, name
+            yield entry.split(' ', 2)
+
+
+def export_user_rows(path, text_path):
+    '''
+    write out the entries of a binary or compressed uids file as an
+    uncompressed text uids file, returning the number of entries
+    '''
+    rows = 0
+    if not is_binary_user_rows(path):
+        with open_input(path) as uid_input, open(text_path, "wb") as output:
+            for chunk in iter(lambda: uid_input.read(1024 * 1024), b""):
+                rows += chunk.count(b"\n")
+                output.write(chunk)
+        return rows
+    with UserRowsFile(path) as rows_file, UserRowsWriter(text_path) as output:
+        for block in rows_file.iter_blocks():
+            output.write_block(*block)
+            rows += len(block[0])
+    return rows
+
+
+def export_outputs(paths, args):
+    '''
+    for each of the given output files that is in the binary format or
+    compressed, write out a plain text copy with .txt added to the name
+    '''
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        if not get_compression(path) and not is_binary_user_rows(path):
+            continue
+        if args['dryrun']:
+            print(f"would export {path} to {path}.txt")
+            continue
+        rows = export_user_rows(path, path + ".txt")
+        if args['verbose']:
+            print(f"exported {rows} entries from {path} to {path}.txt")
+
+
+def batched_rows(rows, count):
+    '''
+    collect a stream of rows into lists of at most count rows
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, count))
+        if not batch:
+            return
+        yield batch
+
+
+def sized_batches(rows, sizer):
+    '''
+    collect a stream of rows into lists of at most sizer.size rows,
+    checking the size again for each list, see BatchSizer
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, sizer.size))
+        if not batch:
+            return
+        yield batch
+
+
+def uid_order(row):
+    '''
+    sort key for uid file rows: by uid, and by name for the same uid
+    '''
+    return (int(row[0].rstrip(',')), row[2])
+
+
+# sort keys for uid file rows, for sort_user_rows
+ROW_ORDERS = {'name': operator.itemgetter(2), 'uid': uid_order}
+
+
+class UserRowStore():
+    '''
+    a compact in-memory list of uid file rows, for when many of them must
+    be held at once: uids and registration dates go into arrays of 64-bit
+    ints and only the names are kept as strings, which takes around a third
+    of the memory of a list of three strings per row. rows are handed back
+    in the form read_user_rows gives them, made up as they are asked for
+    names are not interned, as they are all different within a uids file
+    '''
+    def __init__(self):
+        self.uids = array.array('q')
+        self.registrations = array.array('q')
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, row):
+        '''
+        add a row as read_user_rows returns it
+        '''
+        uid, registration, name = parse_user_row(row)
+        self.uids.append(uid)
+        self.registrations.append(registration)
+        self.names.append(name)
+
+    def get_row(self, index):
+        '''
+        return the row at the given index
+        '''
+        return format_user_row(self.uids[index], self.registrations[index], self.names[index])
+
+    def sorted_rows(self, order):
+        '''
+        yield the rows sorted by name or by uid, see ROW_ORDERS; only a list
+        of the row indexes is sorted, the rows themselves stay where they are
+        '''
+        if order == 'name':
+            index_key = self.names.__getitem__
+        else:
+            index_key = lambda index: (self.uids[index], self.names[index])
+        for index in sorted(range(len(self)), key=index_key):
+            yield self.get_row(index)
+
+
+def sort_user_rows(rows, order, chunk_rows, tempdir):
+    '''
+    sort a stream of uid file rows by name or by uid, holding at most
+    chunk_rows rows in memory, in a UserRowStore; larger inputs are written
+    out in sorted runs to files in tempdir, which are then merged as they
+    are read
+    '''
+    runs = []
+    chunk = UserRowStore()
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            runs.append(write_sorted_run(chunk, order, tempdir, len(runs)))
+            chunk = UserRowStore()
+    if not runs:
+        # everything fit in one chunk, no need to go to disk
+        yield from chunk.sorted_rows(order)
+        return
+    if len(chunk):
+        runs.append(write_sorted_run(chunk, order, tempdir, len(runs)))
+    yield from heapq.merge(*[read_user_rows(run) for run in runs], key=ROW_ORDERS[order])
+
+
+def write_sorted_run(chunk, order, tempdir, run_number):
+    '''
+    sort a chunk of uid file rows and write them to a file in tempdir,
+    returning the path of the file
+    '''
+    run_path = os.path.join(tempdir, f"run_{run_number}")
+    with open(run_path, "w", encoding="utf-8") as run_out:
+        for row in chunk.sorted_rows(order):
+            run_out.write(" ".join(row) + "\n")
+    return run_path
+
+
+def is_in_uid_order(path):
+    '''
+    return True if the entries of the uids file are in ascending uid order
+    '''
+    previous = None
+    for row in read_user_rows(path):
+        key = uid_order(row)
+        if previous is not None and key < previous:
+            return False
+        previous = key
+    return True
+
+
+def read_rows_in_uid_order(path, chunk_rows, tempdir):
+    '''
+    return the entries of the uids file in ascending uid order, sorting
+    them with temporary files in tempdir if they aren't in that order already
+    '''
+    if is_in_uid_order(path):
+        return read_user_rows(path)
+    return sort_user_rows(read_user_rows(path), 'uid', chunk_rows, tempdir)
+
+
+def diff_user_rows(old_path, new_path, added_path, resolved_path, settings, tempdir):
+    '''
+    walk through the entries of two uids files in uid order together, writing
+    those only in the new file to added_path and those only in the old file
+    to resolved_path, and return how many of each there were
+    '''
+    chunk_rows = int(settings['main']['sort_chunk_rows'])
+    batch_rows = int(settings['main']['fetchsize'])
+    old_dir = os.path.join(tempdir, "old")
+    new_dir = os.path.join(tempdir, "new")
+    os.mkdir(old_dir)
+    os.mkdir(new_dir)
+    old_rows = read_rows_in_uid_order(old_path, chunk_rows, old_dir)
+    new_rows = read_rows_in_uid_order(new_path, chunk_rows, new_dir)
+    counts = {'added': 0, 'resolved': 0}
+    with open_user_rows(added_path, settings) as added_out, \
+         open_user_rows(resolved_path, settings) as resolved_out:
+        outputs = {'added': added_out, 'resolved': resolved_out}
+        pending = {'added': [], 'resolved': []}
+
+        def record(kind, row):
+            pending[kind].append(row)
+            counts[kind] += 1
+            if len(pending[kind]) >= batch_rows:
+                outputs[kind].write_rows(pending[kind])
+                pending[kind] = []
+
+        old_row = next(old_rows, None)
+        new_row = next(new_rows, None)
+        while old_row is not None or new_row is not None:
+            if new_row is None or (old_row is not None and
+                                   uid_order(old_row) < uid_order(new_row)):
+                record('resolved', old_row)
+                old_row = next(old_rows, None)
+            elif old_row is None or uid_order(new_row) < uid_order(old_row):
+                record('added', new_row)
+                new_row = next(new_rows, None)
+            else:
+                old_row = next(old_rows, None)
+                new_row = next(new_rows, None)
+        for kind, output in outputs.items():
+            output.write_rows(pending[kind])
+    return counts
+
+
+def get_previous_date(outputdir, stem, date):
+    '''
+    return the date of the latest output file for the stem from before the
+    given date, or None if there is none
+    '''
+    paths = glob.glob(os.path.join(glob.escape(outputdir), f"{stem}_" + "[0-9]" * 8))
+    dates = [os.path.basename(path)[len(stem) + 1:] for path in paths]
+    dates = [earlier for earlier in dates if earlier < date]
+    return max(dates) if dates else None
+
+
+def get_diff_paths(outputdir, stems, date):
+    '''
+    return the paths of the files the diff action writes for the output stems
+    '''
+    return [os.path.join(outputdir, f"{stem}_{kind}_{date}")
+            for stem in stems for kind in ['added', 'resolved']]
+
+
+def diff_outputs(stems, date, args, settings):
+    '''
+    for each of the output stems, compare the file from this run with the one
+    from the run of args['diff_with'], or the latest earlier one, and write
+    the entries that are new since then to <stem>_added_<date> and those
+    no longer there to <stem>_resolved_<date>
+    '''
+    for stem in stems:
+        new_path = os.path.join(args['outputdir'], f"{stem}_{date}")
+        if not os.path.exists(new_path):
+            continue
+        old_date = args['diff_with'] or get_previous_date(args['outputdir'], stem, date)
+        old_path = os.path.join(args['outputdir'], f"{stem}_{old_date}")
+        if not old_date or not os.path.exists(old_path):
+            if args['dryrun'] or args['verbose']:
+                print(f"no earlier {stem} file to compare {new_path} with, skipping")
+            continue
+        added_path, resolved_path = get_diff_paths(args['outputdir'], [stem], date)
+        if args['dryrun']:
+            print(f"would diff {old_path} and {new_path} to {added_path} and {resolved_path}")
+            continue
+        with args['stats'].timed('diff'), \
+             tempfile.TemporaryDirectory(dir=args['outputdir']) as tempdir:
+            counts = diff_user_rows(old_path, new_path, added_path, resolved_path, settings,
+                                    tempdir)
+        args['stats'].add('diff', rows=counts['added'] + counts['resolved'])
+        if args['verbose']:
+            print(f"diff of {old_path} and {new_path}: {counts['added']} added, "
+                  f"{counts['resolved']} resolved")
+
+
+class UserInfoComparer():
+    '''
+    find all entries in a source uids file with user names not in a
+    login uids file, reading both files as streams and writing out
+    missing entries as they are found
+    '''
+    METHODS = ['auto', 'hash', 'merge']
+
+    def __init__(self, args, settings):
+        self.args = args
+        self.method = settings['main']['compare_method']
+        if self.method not in self.METHODS:
+            raise ValueError(f"bad compare method {self.method}, known are {self.METHODS}")
+        self.max_index_bytes = int(settings['main']['compare_max_index_mb']) * 1024 * 1024
+        self.sort_chunk_rows = int(settings['main']['sort_chunk_rows'])
+        self.settings = settings
+        # how many entries to check at once when reading text uids files
+        self.batch_rows = int(settings['main']['fetchsize'])
+        self.stats = {}
+        self.run_stats = args.get('stats') or RunStats()
+
+    def choose_method(self, login_uid_file):
+        '''
+        pick the hash method if the login names will comfortably fit
+        in memory, and the sorted merge otherwise
+        '''
+        if self.method != 'auto':
+            return self.method
+        if get_uncompressed_size(login_uid_file, self.max_index_bytes) <= self.max_index_bytes:
+            return 'hash'
+        return 'merge'
+
+    def load_name_index(self, login_uid_file):
+        '''
+        read the login uids file and return a set of the user names in it
+        '''
+        if is_binary_user_rows(login_uid_file):
+            login_names = set()
+            with UserRowsFile(login_uid_file) as rows_file:
+                for _uids, _registrations, names in rows_file.iter_blocks():
+                    login_names.update(names)
+                    self.stats['login_rows'] += len(names)
+            return login_names
+        login_names = set()
+        for login_row in read_user_rows(login_uid_file):
+            login_names.add(login_row[2])
+            self.stats['login_rows'] += 1
+        return login_names
+
+    def probe_name_index(self, source_uid_file, login_names, missing_out):
+        '''
+        check each source entry against a set of login names, writing
+        out the ones that are not there
+        '''
+        if is_binary_user_rows(source_uid_file):
+            with UserRowsFile(source_uid_file) as rows_file:
+                # only the names are needed, except for entries that are missing
+                for uids, registrations, names in rows_file.iter_blocks():
+                    missing = [i for i, name in enumerate(names) if name not in login_names]
+                    missing_out.write_block([uids[i] for i in missing],
+                                            [registrations[i] for i in missing],
+                                            [names[i] for i in missing])
+                    self.stats['source_rows'] += len(names)
+                    self.stats['missing_rows'] += len(missing)
+            return
+        for batch in batched_rows(read_user_rows(source_uid_file), self.batch_rows):
+            self.stats['source_rows'] += len(batch)
+            missing = [source_row for source_row in batch if source_row[2] not in login_names]
+            missing_out.write_rows(missing)
+            self.stats['missing_rows'] += len(missing)
+
+    def compare_hashed(self, source_uid_file, login_uid_file, missing_out):
+        '''
+        build an in-memory set of the login names, then check each
+        source entry against it
+        '''
+        login_names = self.load_name_index(login_uid_file)
+        self.probe_name_index(source_uid_file, login_names, missing_out)
+
+    def compare_merged(self, source_uid_file, login_uid_file, missing_out):
+        '''
+        sort both files by user name, using temporary files for anything
+        that won't fit in a sort chunk, then walk through them together,
+        writing out the source entries with no matching login name.
+        note that the entries are written in name order, not uid order
+        '''
+        with tempfile.TemporaryDirectory(dir=self.args['outputdir']) as tempdir:
+            source_dir = os.path.join(tempdir, "source")
+            login_dir = os.path.join(tempdir, "login")
+            os.mkdir(source_dir)
+            os.mkdir(login_dir)
+            login_rows = sort_user_rows(read_user_rows(login_uid_file), 'name',
+                                        self.sort_chunk_rows, login_dir)
+            source_rows = sort_user_rows(read_user_rows(source_uid_file), 'name',
+                                         self.sort_chunk_rows, source_dir)
+            login_name = self.next_login_name(login_rows)
+            missing = []
+            for source_row in source_rows:
+                self.stats['source_rows'] += 1
+                while login_name is not None and login_name < source_row[2]:
+                    login_name = self.next_login_name(login_rows)
+                if login_name != source_row[2]:
+                    missing.append(source_row)
+                    self.stats['missing_rows'] += 1
+                    if len(missing) >= self.batch_rows:
+                        missing_out.write_rows(missing)
+                        missing = []
+            missing_out.write_rows(missing)
+            # count whatever is left so the rate covers both inputs
+            for _row in login_rows:
+                self.stats['login_rows'] += 1
+
+    def next_login_name(self, login_rows):
+        '''
+        return the name from the next sorted login row, or None if there are no more
+        '''
+        login_row = next(login_rows, None)
+        if login_row is None:
+            return None
+        self.stats['login_rows'] += 1
+        return login_row[2]
+
+    def start_stats(self, method):
+        '''
+        reset the counters for a new comparison
+        '''
+        self.stats = {'method': method, 'source_rows': 0, 'login_rows': 0, 'missing_rows': 0,
+                      'started': time.monotonic()}
+
+    def finish_stats(self, label, stage='compare'):
+        '''
+        work out the rate for the comparison just done, display it, add it to
+        the --stats report under the given stage and return the stats
+        '''
+        elapsed = time.monotonic() - self.stats.pop('started')
+        self.stats['seconds'] = elapsed
+        total = self.stats['source_rows'] + self.stats['login_rows']
+        self.stats['rows_per_sec'] = total / elapsed if elapsed else float(total)
+        self.run_stats.add(stage, seconds=elapsed,
+                           rows=total, missing_rows=self.stats['missing_rows'])
+        if 'login_names' in self.stats:
+            # checked against names loaded earlier, none read here
+            login = f"{self.stats['login_names']} login names"
+        else:
+            login = f"{self.stats['login_rows']} login rows"
+        print(f"{label} ({self.stats['method']}): {self.stats['source_rows']} source rows, "
+              f"{login}, {self.stats['missing_rows']} missing, "
+              f"{self.stats['rows_per_sec']:.0f} rows/sec")
+        return self.stats
+
+    def compare(self, source_uid_file, login_uid_file, missing_output):
+        '''
+        write all entries in the source uids file not in the login uids file
+        to the missing output file, and return some stats about the run
+        '''
+        workers = self.args.get('workers', 1)
+        method = self.choose_method(login_uid_file) if workers < 2 else 'partitioned'
+        self.start_stats(method)
+        with open_user_rows(missing_output, self.settings) as missing_out:
+            if method == 'partitioned':
+                self.compare_partitioned(source_uid_file, login_uid_file, missing_out, workers)
+            elif method == 'hash':
+                self.compare_hashed(source_uid_file, login_uid_file, missing_out)
+            else:
+                self.compare_merged(source_uid_file, login_uid_file, missing_out)
+        return self.finish_stats("compare")
+
+    def compare_partitioned(self, source_uid_file, login_uid_file, missing_out, workers):
+        '''
+        split both files by a hash of the user name into as many shards as
+        there are workers, compare each shard in a process of its own, then
+        put the missing entries from all the shards back in source file order
+        each input is split in turn into one piece per worker, and the pieces
+        are sharded at the same time, so no one process reads all of either file
+        the workers are started fresh rather than forked, since by now this
+        process has other threads running (pool keepalive, concurrent actions)
+        '''
+        context = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory(dir=self.args['outputdir']) as tempdir, \
+             concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    mp_context=context) as pool:
+            sharding = {pool.submit(shard_uids_file, path, label, part, workers, tempdir): label
+                        for path, label in [(source_uid_file, 'source'),
+                                            (login_uid_file, 'login')]
+                        for part in range(workers)}
+            for future in concurrent.futures.as_completed(sharding):
+                self.stats[f"{sharding[future]}_rows"] += future.result()
+            missing_paths = list(pool.map(compare_uids_shard, range(workers),
+                                          [workers] * workers, [tempdir] * workers))
+            missing = []
+            for _key, line in heapq.merge(*[read_keyed_lines(path) for path in missing_paths]):
+                missing.append(line.decode('utf-8').rstrip('\n').split(' ', 2))
+                self.stats['missing_rows'] += 1
+                if len(missing) >= self.batch_rows:
+                    missing_out.write_rows(missing)
+                    missing = []
+            missing_out.write_rows(missing)
+
+    def compare_with_index(self, source_uid_file, login_names, missing_output, label="compare"):
+        '''
+        write all entries in the source uids file with names not in the
+        already loaded set of login names to the missing output file, and
+        return some stats about the run
+        '''
+        self.start_stats('index')
+        self.stats['login_names'] = len(login_names)
+        with open_user_rows(missing_output, self.settings) as missing_out:
+            self.probe_name_index(source_uid_file, login_names, missing_out)
+        return self.finish_stats(label)
+
+
+def iter_uids_file_part(path, part, parts):
+    '''
+    yield a sort key and the entry as a line of text in bytes without the
+    newline, for each entry in part number part of parts pieces of the uids
+    file; the pieces are in file order, and so are the keys across them
+    text files are split into byte ranges, each line going with the range it
+    starts in, and binary files into runs of blocks; compressed files can
+    only be read from the start, so all of them is in part 0
+    '''
+    if is_binary_user_rows(path):
+        with UserRowsFile(path) as rows_file:
+            if rows_file.compressed and part:
+                return
+            first = 0 if rows_file.compressed else len(rows_file.blocks) * part // parts
+            last = None if rows_file.compressed else len(rows_file.blocks) * (part + 1) // parts
+            for block_number, (uids, registrations, names) in enumerate(
+                    rows_file.iter_blocks(first, last), first):
+                for index, row in enumerate(map(format_user_row, uids, registrations, names)):
+                    yield (block_number << 32) + index, " ".join(row).encode('utf-8')
+        return
+    if get_compression(path):
+        if part:
+            return
+        with open_input(path) as uid_input:
+            for line_number, line in enumerate(uid_input):
+                yield line_number, line.rstrip(b"\n")
+        return
+    size = os.path.getsize(path)
+    start = size * part // parts
+    end = size * (part + 1) // parts
+    with open(path, "rb") as uid_input:
+        if start:
+            # skip the rest of the line that started in the previous range
+            uid_input.seek(start - 1)
+            start += len(uid_input.readline()) - 1
+        # the key is the offset of the line in the file
+        position = start
+        leftover = b""
+        while position < end:
+            chunk = uid_input.read(SHARD_READ_BYTES)
+            if not chunk:
+                if leftover:
+                    yield position, leftover
+                return
+            lines = (leftover + chunk).split(b"\n")
+            leftover = lines.pop()
+            for line in lines:
+                if position >= end:
+                    return
+                yield position, line
+                position += len(line) + 1
+
+
+def shard_uids_file(path, label, part, shards, tempdir):
+    '''
+    write out the entries of one piece of the uids file (see iter_uids_file_part)
+    to one file per shard in tempdir, choosing the shard by a hash of the user
+    name, and return the number of entries; source entries are written with
+    their sort keys in front, for login entries only the names are needed
+    this runs in a worker process, see UserInfoComparer.compare_partitioned
+    '''
+    outputs = [open(os.path.join(tempdir, f"{label}_{part}_{shard}"), "wb",
+                    buffering=SHARD_READ_BYTES)
+               for shard in range(shards)]
+    rows = 0
+    try:
+        for key, line in iter_uids_file_part(path, part, shards):
+            fields = line.split(b" ", 2)
+            if len(fields) < 3:
+                continue
+            output = outputs[zlib.crc32(fields[2]) % shards]
+            if label == 'login':
+                output.write(fields[2] + b"\n")
+            else:
+                output.write(b"%d %s\n" % (key, line))
+            rows += 1
+    finally:
+        for output in outputs:
+            output.close()
+    return rows
+
+
+def read_keyed_lines(path):
+    '''
+    yield the sort key and the entry, as a line of bytes, from each line
+    of a file of missing entries written by compare_uids_shard
+    '''
+    with open(path, "rb") as keyed_input:
+        for keyed_line in keyed_input:
+            key, line = keyed_line.split(b" ", 1)
+            yield int(key), line
+
+
+def compare_uids_shard(shard, parts, tempdir):
+    '''
+    load the login names from all pieces of the given shard, then write out
+    the source entries in the shard with names not among them, in source
+    file order and with their sort keys, returning the path of the file
+    this runs in a worker process, see UserInfoComparer.compare_partitioned
+    '''
+    login_names = set()
+    for part in range(parts):
+        with open(os.path.join(tempdir, f"login_{part}_{shard}"), "rb") as login_input:
+            login_names.update(login_input.read().split(b"\n"))
+    missing_path = os.path.join(tempdir, f"missing_{shard}")
+    with open(missing_path, "wb") as missing_out:
+        for part in range(parts):
+            with open(os.path.join(tempdir, f"source_{part}_{shard}"), "rb",
+                      buffering=SHARD_READ_BYTES) as source_input:
+                for keyed_line in source_input:
+                    if keyed_line[:-1].split(b" ", 3)[3] not in login_names:
+                        missing_out.write(keyed_line)
+    return missing_path
+
+
+def compare_user_info(source_uid_file, login_uid_file, missing_output, args, settings):
     '''
     find all entries in source uids file not in login uids.
     note that these aren't necessarily missing completely from
@@ -501,26 +3466,164 @@ def compare_user_info(source_uid_file, login_uid_file, missing_output):
     wiki much earlier and registered on the loginwiki at that
     time, hence missing from our uid interval
     '''
-    with open(login_uid_file, "r", encoding="utf-8") as login_input:
-        content = login_input.read()
-        login_input.close()
-        login_entries = content.splitlines()
-        # format:  uid registr_date name
-        login_rows = [login_entry.split(' ',2) for login_entry in login_entries]
-        login_names = [login_row[2] for login_row in login_rows]
-
-    with open(source_uid_file, "r", encoding="utf-8") as source_input:
-        content = source_input.read()
-        source_input.close()
-        source_entries = content.splitlines()
-        # format:  uid registr_date name
-        source_rows = [source_entry.split(' ',2) for source_entry in source_entries]
-        missing = [source_row for source_row in source_rows if source_row[2] not in login_names]
-
-    with open(missing_output, "w", encoding="utf-8") as missing_out:
-        for row in missing:
-            missing_out.write(" ".join(row) + "\n")
-        missing_out.close()
+    comparer = UserInfoComparer(args, settings)
+    return comparer.compare(source_uid_file, login_uid_file, missing_output)
+
+def tee_rows(rows, path, settings):
+    '''
+    pass rows through unchanged, also writing each of them to
+    the file at path, unless path is None
+    '''
+    if not path:
+        yield from rows
+        return
+    batch_rows = int(settings['main']['fetchsize'])
+    with open_user_rows(path, settings) as output:
+        pending = []
+        for row in rows:
+            pending.append(row)
+            if len(pending) >= batch_rows:
+                output.write_rows(pending)
+                pending = []
+            yield row
+        output.write_rows(pending)
+
+
+def count_rows(rows, counts, name):
+    '''
+    pass rows through unchanged, counting them in counts[name]
+    '''
+    counts[name] = 0
+    for row in rows:
+        counts[name] += 1
+        yield row
+
+
+def run_pipeline(args, settings, queries, outputs, count):
+    '''
+    run the source, login, compare, gone and global actions as one chain
+    of generators: the loginwiki names go into a set, the source wiki rows
+    are streamed past it, and the names not there go straight on to be
+    looked up in the loginwiki user table and then the global user table,
+    in batches, without any of the rows going through files in between
+    only the outputs whose names (source_uids, login_uids, missing_uids,
+    gone_uids, global_uids) are listed in the pipeline_outputs setting
+    are written, as a side effect
+    '''
+    keep = [stem.strip() for stem in settings['main']['pipeline_outputs'].split(",")
+            if stem.strip()]
+    side_outputs = {stem: path if stem in keep else None for stem, path in outputs.items()}
+    counts = {}
+
+    with contextlib.ExitStack() as stack:
+        login_rows = queries['login'].iter_user_batches(args['login_uids'], count)
+        login_rows = tee_rows(login_rows, side_outputs['login_uids'], settings)
+        login_names = {row[2] for row in count_rows(login_rows, counts, 'login')}
+
+        rows = queries['source'].iter_user_batches(args['source_uids'], count)
+        rows = count_rows(tee_rows(rows, side_outputs['source_uids'], settings), counts,
+                          'source')
+        rows = (row for row in rows if row[2] not in login_names)
+        rows = count_rows(tee_rows(rows, side_outputs['missing_uids'], settings), counts,
+                          'missing')
+        if 'gone' in args['actions']:
+            rows = queries['login'].filter_missing_names(rows)
+            rows = count_rows(tee_rows(rows, side_outputs['gone_uids'], settings), counts,
+                              'gone')
+        if 'global' in args['actions']:
+            present_out = None
+            if side_outputs['global_uids']:
+                present_out = stack.enter_context(
+                    open_text_output(side_outputs['global_uids'] + "_present", settings))
+            rows = queries['global'].filter_global_names(rows, present_out)
+            rows = count_rows(tee_rows(rows, side_outputs['global_uids'], settings), counts,
+                              'global')
+
+        # pull everything through
+        for _row in rows:
+            pass
+
+    print("pipeline: " + ", ".join(f"{counts[name]} {name}" for name in
+                                   ['source', 'login', 'missing', 'gone', 'global']
+                                   if name in counts))
+    return counts
+
+
+def write_stats_report(args, date):
+    '''
+    if asked for, write out the stats collected during the run as json
+    '''
+    if not args['show_stats']:
+        return
+    stats_output = os.path.join(args['outputdir'], f"stats_{date}.json")
+    with open(stats_output, "w", encoding="utf-8") as stats_out:
+        json.dump(args['stats'].get_report(), stats_out, indent=2)
+        stats_out.write("\n")
+    print("stats written to", stats_output)
+
+
+def get_db_password(settings):
+    '''
+    return the db password, read from the first line of the dbpassword_file
+    if that is set, so that no one need be around to type it in
+    '''
+    if settings['main']['dbpassword_file']:
+        with open(settings['main']['dbpassword_file'], "r", encoding="utf-8") as password_in:
+            return password_in.readline().rstrip("\n")
+    return getpass("DB password: ")
+
+
+def has_new_users(args, settings, dbcreds, pool):
+    '''
+    return True if any of the source wikis has accounts newer than the last
+    uid checked, or an extraction that was not finished
+    '''
+    if args['all_wikis'] or args['sections']:
+        fleet_scanner = WikiFleetScanner(args, settings, dbcreds, None, pool)
+        return fleet_scanner.has_new_users()
+    checkpoint = UidCheckpoint(get_state_dir(args, settings), args['sourcewiki'], args['dryrun'])
+    dbconn = DBConn(args['sourcewiki'], dbcreds['user'], dbcreds['password'], settings, pool)
+    dbconn.get_conn()
+    try:
+        queries = QueryRunner(dbconn, args)
+        queries.init_conn()
+        return checkpoint.has_new_uids(queries)
+    finally:
+        dbconn.close()
+
+
+def watch_for_new_users(args, settings, dbcreds, pool):
+    '''
+    every watch_interval seconds, check whether there are new source wiki
+    accounts, and if so, run the actions for just those, adding what is
+    found to the cumulative output files; a run that fails because of db
+    or file errors is reported and picked up again on the next check. this
+    goes on until interrupted
+    '''
+    interval = int(settings['main']['watch_interval'])
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                # wikis may have been added or moved since the last check
+                refresh_section_index(settings)
+                if has_new_users(args, settings, dbcreds, pool):
+                    # each run works out its own uid intervals, and has a
+                    # stats report of its own
+                    run_args = dict(args)
+                    run_args['stats'] = RunStats()
+                    if 'login_uids' in args:
+                        run_args['login_uids'] = dict(args['login_uids'])
+                    run_checks(run_args, settings, dbcreds, pool)
+                elif args['dryrun'] or args['verbose']:
+                    print("no new users since the last check")
+            except (MySQLdb.Error, RuntimeError, OSError) as ex:
+                sys.stderr.write(f"checks failed, will try again at the next check: {ex}\n")
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+    except KeyboardInterrupt:
+        if args['dryrun'] or args['verbose']:
+            print("stopped watching for new users")
+
 
 def do_main():
     '''
@@ -529,9 +3632,14 @@ def do_main():
     args = OptHandler.get_opt_defaults()
     try:
         (options, remainder) = getopt.gnu_getopt(
-            sys.argv[1:], 'a:c:l:L:s:S:o:dvh', ['actions=', 'config=', 'loginwiki=', 'login_uids=',
-                                            'sourcewiki=', 'source_uids=',
-                                            'outputdir=','dryrun', 'verbose', 'help'])
+            sys.argv[1:], 'a:c:l:L:s:S:b:e:AX:iwPD:o:p:j:tdvh', ['actions=', 'config=',
+                                                     'loginwiki=', 'login_uids=',
+                                                     'sourcewiki=', 'source_uids=',
+                                                     'since=', 'until=',
+                                                     'all-wikis', 'section=', 'incremental',
+                                                     'watch', 'pipeline', 'diff-with=', 'stats',
+                                                   'outputdir=', 'parallel=', 'workers=',
+                                              'dryrun', 'verbose', 'help'])
     except getopt.GetoptError as err:
         usage("Unknown option specified: " + str(err))
 
@@ -544,6 +3652,18 @@ def do_main():
     for action in args['actions']:
         if action not in KNOWN_ACTIONS:
             usage(f"Unknown action specified: {action}, known are {KNOWN_ACTIONS}")
+    if args['pipeline']:
+        if not all(action in args['actions'] for action in ['source', 'login', 'compare']):
+            usage("--pipeline needs at least the source, login and compare actions")
+        if (args['all_wikis'] or args['sections'] or args['incremental'] or
+                args['parallel'] > 1):
+            usage("--pipeline can't be used with --all-wikis, --section, --incremental, "
+                  "--watch or --parallel")
+    if args['watch'] and not all(action in args['actions'] for action in ['source', 'compare']):
+        usage("--watch needs at least the source and compare actions")
+    if args['incremental'] and 'diff' in args['actions']:
+        # the dated files of these runs have only the new entries
+        usage("the diff action can't be used with --incremental or --watch")
 
     settings = OptHandler.get_settings(args['config'])
     if (args['dryrun'] or args['verbose']):
@@ -551,76 +3671,218 @@ def do_main():
 
     mysql_user = settings['main']['dbuser']
 
+    mysql_password = None
     if ('source' in args['actions'] or 'login' in args['actions'] or
         'gone' in args['actions'] or 'global' in args['actions']):
-        mysql_password = getpass("DB password: ")
-
-    if 'source' in args['actions']:
-        source_dbconn = DBConn(args['sourcewiki'], mysql_user, mysql_password, settings)
-        source_dbconn.get_conn()
-        if (args['dryrun'] or args['verbose']):
-            print("source wiki db connection established")
-
-        source_queries = QueryRunner(source_dbconn, args)
-        source_queries.init_conn()
-
-        if 'source_uids' not in args:
-            args['source_uids'] = source_queries.get_uid_range(DEFAULT_UID_INTERVAL, -1)
-        elif args['source_uids']['end'] == -1:
-            args['source_uids']['end'] = source_queries.get_max_uid()
-        if (args['dryrun'] or args['verbose']):
-            print("source uids is", args['source_uids'])
-
-    if 'login' in args['actions'] or 'gone' in args['actions']:
-        login_dbconn = DBConn(args['loginwiki'], mysql_user, mysql_password, settings)
-        login_dbconn.get_conn()
-        if (args['dryrun'] or args['verbose']):
-            print("login wiki db connection established")
-
-        login_queries = QueryRunner(login_dbconn, args)
-        login_queries.init_conn()
-
-    if 'login' in args['actions']:
-        if 'login_uids' not in args:
-            args['login_uids'] = login_queries.get_uid_range(2 * DEFAULT_UID_INTERVAL, -1)
-        elif args['login_uids']['end'] == -1:
-            args['login_uids']['end'] = login_queries.get_max_uid()
-
-        if (args['dryrun'] or args['verbose']):
-            print("login uids is", args['login_uids'])
-
-    if 'global' in args['actions']:
-        global_dbconn = DBConn('centralauth', mysql_user, mysql_password, settings)
-        global_dbconn.get_conn()
-        if (args['dryrun'] or args['verbose']):
-            print("centralauth db connection established")
-
-        global_queries = QueryRunner(global_dbconn, args)
-        global_queries.init_conn()
+        mysql_password = get_db_password(settings)
 
-    date = time.strftime("%Y%m%d", time.gmtime())
-    count = int(settings['main']['batchsize'])
+    # connections are shared by all wikis on the same db server
+    pool = ConnectionPool(mysql_user, mysql_password, settings)
+    pool.start_keepalive()
+
+    dbcreds = {'user': mysql_user, 'password': mysql_password}
+    if args['watch']:
+        watch_for_new_users(args, settings, dbcreds, pool)
+    else:
+        run_checks(args, settings, dbcreds, pool)
+
+    pool.close_all()
 
+
+def run_checks(args, settings, dbcreds, pool):
+    '''
+    run the requested actions once, using connections from the pool
+    '''
+    mysql_user = dbcreds['user']
+    mysql_password = dbcreds['password']
+    date = time.strftime("%Y%m%d", time.gmtime())
     source_output = os.path.join(args['outputdir'], f"source_uids_{date}")
     login_output = os.path.join(args['outputdir'], f"login_uids_{date}")
     compare_output = os.path.join(args['outputdir'], f"missing_uids_{date}")
     gone_output = os.path.join(args['outputdir'], f"gone_uids_{date}")
     global_output = os.path.join(args['outputdir'], f"global_uids_{date}")
 
-    if 'source' in args['actions']:
-        source_queries.get_user_batches(args['source_uids'], source_output, count)
+    # given back to the pool at the end, to be reused by the next run if we are watching
+    dbconns = []
+    # the ones whose name lookups go into a name index, saved at the end
+    lookup_queries = []
+    try:
+        fleet = args['all_wikis'] or args['sections']
+        if fleet:
+            fleet_scanner = WikiFleetScanner(args, settings, dbcreds, date, pool)
+
+        if 'source' in args['actions'] and not fleet:
+            source_dbconn = DBConn(args['sourcewiki'], mysql_user, mysql_password, settings, pool)
+            dbconns.append(source_dbconn)
+            source_dbconn.get_conn()
+            if (args['dryrun'] or args['verbose']):
+                print("source wiki db connection established")
+
+            source_queries = QueryRunner(source_dbconn, args)
+            source_queries.init_conn()
+
+            source_checkpoint = None
+            if args['incremental']:
+                source_checkpoint = UidCheckpoint(get_state_dir(args, settings), args['sourcewiki'],
+                                                  args['dryrun'])
+            if source_checkpoint and 'source_uids' not in args and source_checkpoint.get_pending():
+                # finish up what the last run didn't
+                pending = source_checkpoint.get_pending()
+                args['source_uids'] = {'start': pending['start'], 'end': pending['end']}
+                source_output = pending['output']
+            elif source_checkpoint and 'source_uids' not in args:
+                args['source_uids'] = source_checkpoint.get_new_uids(source_queries,
+                                                                     DEFAULT_UID_INTERVAL)
+            elif 'source_uids' not in args and (args['since'] or args['until']):
+                args['source_uids'] = source_queries.get_uid_range_for_dates(args['since'],
+                                                                             args['until'])
+            elif 'source_uids' not in args:
+                args['source_uids'] = source_queries.get_uid_range(DEFAULT_UID_INTERVAL, -1)
+            elif args['source_uids']['end'] == -1:
+                args['source_uids']['end'] = source_queries.get_max_uid()
+            if (args['dryrun'] or args['verbose']):
+                print("source uids is", args['source_uids'])
+
+        if 'login' in args['actions'] or 'gone' in args['actions']:
+            login_dbconn = DBConn(args['loginwiki'], mysql_user, mysql_password, settings, pool)
+            dbconns.append(login_dbconn)
+            login_dbconn.get_conn()
+            if (args['dryrun'] or args['verbose']):
+                print("login wiki db connection established")
+
+            login_queries = QueryRunner(login_dbconn, args)
+            login_queries.init_conn()
+            lookup_queries.append(login_queries)
+
+        if 'login' in args['actions']:
+            if 'login_uids' not in args and (args['since'] or args['until']):
+                args['login_uids'] = login_queries.get_uid_range_for_dates(args['since'],
+                                                                            args['until'])
+            elif 'login_uids' not in args:
+                args['login_uids'] = login_queries.get_uid_range(2 * DEFAULT_UID_INTERVAL, -1)
+            elif args['login_uids']['end'] == -1:
+                args['login_uids']['end'] = login_queries.get_max_uid()
+
+            if (args['dryrun'] or args['verbose']):
+                print("login uids is", args['login_uids'])
+
+        if 'global' in args['actions']:
+            global_dbconn = DBConn('centralauth', mysql_user, mysql_password, settings, pool)
+            dbconns.append(global_dbconn)
+            global_dbconn.get_conn()
+            if (args['dryrun'] or args['verbose']):
+                print("centralauth db connection established")
+
+            global_queries = QueryRunner(global_dbconn, args)
+            global_queries.init_conn()
+
+        count = int(settings['main']['batchsize'])
+
+        if args['pipeline']:
+            run_pipeline(args, settings,
+                         {'source': source_queries, 'login': login_queries,
+                          'global': global_queries if 'global' in args['actions'] else None},
+                         {'source_uids': source_output, 'login_uids': login_output,
+                          'missing_uids': compare_output, 'gone_uids': gone_output,
+                          'global_uids': global_output}, count)
+            for queries in lookup_queries:
+                queries.save_name_index()
+            if 'diff' in args['actions']:
+                diff_outputs(DIFF_STEMS, date, args, settings)
+            if 'export' in args['actions']:
+                export_outputs([source_output, login_output, compare_output, gone_output,
+                                global_output] +
+                               get_diff_paths(args['outputdir'], DIFF_STEMS, date), args)
+            write_stats_report(args, date)
+            return
 
-    if 'login' in args['actions']:
-        login_queries.get_user_batches(args['login_uids'], login_output, count)
+        # actions that don't depend on each other run at the same time: source
+        # and login extraction use different db servers, and when both gone
+        # and global are to be run, the global check works through each batch
+        # as soon as the gone check is done with it
+        tasks = {}
+        if 'source' in args['actions']:
+            if fleet:
+                tasks['source'] = lambda: fleet_scanner.extract_sources(count)
+            elif args['parallel'] > 1:
+                tasks['source'] = lambda: source_queries.get_user_batches_parallel(
+                    args['source_uids'], source_output, count, args['parallel'], source_checkpoint)
+            else:
+                tasks['source'] = lambda: source_queries.get_user_batches(
+                    args['source_uids'], source_output, count, source_checkpoint)
 
-    if 'compare' in args['actions']:
-        compare_user_info(source_output, login_output, compare_output)
+        if 'login' in args['actions']:
+            if args['parallel'] > 1:
+                tasks['login'] = lambda: login_queries.get_user_batches_parallel(
+                    args['login_uids'], login_output, count, args['parallel'])
+            else:
+                tasks['login'] = lambda: login_queries.get_user_batches(
+                    args['login_uids'], login_output, count)
 
-    if 'gone' in args['actions']:
-        login_queries.check_missing_uids(compare_output, gone_output)
+        if 'compare' in args['actions']:
+            if fleet:
+                tasks['compare'] = lambda: fleet_scanner.compare_sources(login_output)
+            else:
+                tasks['compare'] = lambda: compare_user_info(
+                    source_output, login_output, compare_output, args, settings)
 
-    if 'global' in args['actions']:
-        global_queries.check_global_users(gone_output, global_output)
+        if 'gone' in args['actions'] and 'global' in args['actions']:
+            if fleet:
+                tasks['gone'] = lambda: fleet_scanner.check_gone_and_global(login_queries,
+                                                                            global_queries)
+            else:
+                tasks['gone'] = lambda: check_gone_and_global(
+                    login_queries, global_queries, compare_output, gone_output, global_output)
+        elif 'gone' in args['actions']:
+            if fleet:
+                tasks['gone'] = lambda: fleet_scanner.check_missing(login_queries)
+            else:
+                tasks['gone'] = lambda: login_queries.check_missing_uids(compare_output,
+                                                                         gone_output)
+        elif 'global' in args['actions']:
+            if fleet:
+                tasks['global'] = lambda: fleet_scanner.check_global(global_queries)
+            else:
+                tasks['global'] = lambda: global_queries.check_global_users(gone_output,
+                                                                            global_output)
+
+        run_actions(tasks, args['dryrun'] or args['verbose'])
+        for queries in lookup_queries:
+            queries.save_name_index()
+
+        # the new entries only count as checked once they have been compared
+        if args['incremental'] and 'source' in args['actions'] and 'compare' in args['actions']:
+            if fleet:
+                fleet_scanner.finish_checks()
+            else:
+                if not args['dryrun']:
+                    for stem, output, action in [("missing_uids", compare_output, 'compare'),
+                                                 ("gone_uids", gone_output, 'gone'),
+                                                 ("global_uids", global_output, 'global')]:
+                        if action not in args['actions']:
+                            continue
+                        append_to_cumulative(
+                            output, os.path.join(args['outputdir'], f"{stem}_cumulative"))
+                source_checkpoint.finish_check()
+
+        if 'diff' in args['actions']:
+            if fleet:
+                fleet_scanner.diff_outputs()
+            else:
+                diff_outputs(DIFF_STEMS, date, args, settings)
+
+        if 'export' in args['actions']:
+            if fleet:
+                fleet_scanner.export_outputs(login_output)
+            else:
+                export_outputs([source_output, login_output, compare_output, gone_output,
+                                global_output] +
+                               get_diff_paths(args['outputdir'], DIFF_STEMS, date), args)
+
+        write_stats_report(args, date)
+    finally:
+        for dbconn in dbconns:
+            dbconn.close()
 
 
 if __name__ == '__main__':
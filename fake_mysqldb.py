@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+a stand-in for the MySQLdb module, good enough to run the account
+creation checks against local sqlite files instead of the analytics
+replicas, for benchmarking
+
+each wiki db is a sqlite file named <wikidb>.sqlite in the data
+directory given to configure(); every statement executed and every
+connection made can be slowed down by a fixed latency to look a bit
+more like a trip over the network
+
+user names and registration dates should be stored as blobs, as
+they are varbinary columns in MediaWiki; string query parameters are
+turned into utf-8 bytes so that they compare the same way
+
+EXPLAIN gives sqlite's query plan dressed up as mysql's, with a row
+per table and its join type and key, and SHOW STATUS LIKE 'Handler_read%'
+gives a read counter for the connection which goes up by one for each
+row fetched, which is as near to rows examined as we can easily get
+"""
+
+import os.path
+import re
+import sqlite3
+import threading
+import time
+import types
+
+paramstyle = 'format'
+threadsafety = 1
+
+SETTINGS = {'datadir': '.', 'latency': 0.0}
+USE_RE = re.compile(r'^\s*use\s+(\w+)\s*;?\s*$', re.IGNORECASE)
+SHOW_RE = re.compile(r'^\s*show\s', re.IGNORECASE)
+HANDLER_STATUS_RE = re.compile(r"^\s*show\s+(session\s+)?status\s+like\s+'handler_read",
+                               re.IGNORECASE)
+EXPLAIN_RE = re.compile(r'^\s*explain\s+', re.IGNORECASE)
+# mysql's EXPLAIN columns
+EXPLAIN_COLUMNS = ['id', 'select_type', 'table', 'type', 'possible_keys', 'key', 'key_len',
+                   'ref', 'rows', 'Extra']
+
+# number of connections made and statements run, for the curious
+COUNTERS = {'connects': 0, 'queries': 0}
+COUNTERS_LOCK = threading.Lock()
+
+
+class Error(Exception):
+    '''
+    base class for db errors, args are (error code, message) as with MySQLdb
+    '''
+
+
+class OperationalError(Error):
+    '''
+    something went wrong with the connection
+    '''
+
+
+class ProgrammingError(Error):
+    '''
+    something is wrong with the query
+    '''
+
+
+def configure(datadir, latency=0.0):
+    '''
+    set the directory with the sqlite files for the wiki dbs,
+    and how many seconds each connect or statement should take
+    '''
+    SETTINGS['datadir'] = datadir
+    SETTINGS['latency'] = latency
+
+
+def count(counter):
+    '''
+    bump one of the counters, and wait for the configured latency
+    '''
+    with COUNTERS_LOCK:
+        COUNTERS[counter] += 1
+    if SETTINGS['latency']:
+        time.sleep(SETTINGS['latency'])
+
+
+class Cursor():
+    '''
+    run statements on a fake connection; rows are read from sqlite
+    as they are fetched, so this works as an unbuffered cursor too
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = None
+        self.rowcount = -1
+        self.description = None
+        self.counting = False
+
+    @staticmethod
+    def convert_query(query, params):
+        '''
+        turn a MySQLdb style query and parameters into sqlite ones
+        '''
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        if params is None:
+            return query, []
+        query = query.replace('%s', '?')
+        params = [param.encode('utf-8') if isinstance(param, str) else param
+                  for param in params]
+        return query, params
+
+    @staticmethod
+    def describe(columns):
+        '''
+        return a cursor description for the column names
+        '''
+        return tuple((column, None, None, None, None, None, None) for column in columns)
+
+    def explain(self, query, params):
+        '''
+        turn sqlite's plan for the query into rows like mysql's EXPLAIN gives:
+        SCAN is a full table scan (ALL), or a full index scan (index) if it
+        goes through an index, and SEARCH is a range or key lookup
+        '''
+        try:
+            steps = self.conn.sqlite.execute(
+                "EXPLAIN QUERY PLAN " + query.rstrip().rstrip(';'), params).fetchall()
+        except sqlite3.Error as ex:
+            raise ProgrammingError(1064, str(ex)) from ex
+        rows = []
+        for step in steps:
+            detail = step[-1]
+            words = detail.split()
+            if len(words) < 2 or words[0] not in ('SCAN', 'SEARCH'):
+                continue
+            index = re.search(r'USING (?:COVERING )?INDEX (\w+)', detail)
+            if 'PRIMARY KEY' in detail:
+                key = 'PRIMARY'
+            else:
+                key = index.group(1) if index else None
+            if words[0] == 'SCAN':
+                join_type = 'index' if key else 'ALL'
+            else:
+                join_type = 'range' if re.search(r'[<>]', detail) else 'ref'
+            rows.append((len(rows) + 1, 'SIMPLE', words[1], join_type, key, key, None, None,
+                         None, detail))
+        self.description = self.describe(EXPLAIN_COLUMNS)
+        self.result = iter(rows)
+        return len(rows)
+
+    def execute(self, query, params=None):
+        '''
+        run a statement; use <db> switches the connection to that db,
+        show statements have empty results except for the handler read
+        counter, and explain gives a made up plan
+        '''
+        count('queries')
+        query, params = self.convert_query(query, params)
+        self.result = None
+        self.description = None
+        self.counting = False
+        match = USE_RE.match(query)
+        if match:
+            self.conn.select_db(match.group(1))
+            return 0
+        if HANDLER_STATUS_RE.match(query):
+            self.description = self.describe(['Variable_name', 'Value'])
+            self.result = iter([('Handler_read_next', str(self.conn.handler_reads))])
+            return 1
+        if SHOW_RE.match(query):
+            self.result = iter([])
+            return 0
+        if not self.conn.sqlite:
+            raise OperationalError(1046, "No database selected")
+        if EXPLAIN_RE.match(query):
+            return self.explain(EXPLAIN_RE.sub('', query), params)
+        try:
+            cursor = self.conn.sqlite.execute(query.rstrip().rstrip(';'), params)
+        except sqlite3.Error as ex:
+            raise ProgrammingError(1064, str(ex)) from ex
+        self.description = cursor.description
+        self.rowcount = cursor.rowcount
+        self.result = cursor
+        self.counting = True
+        return self.rowcount
+
+    def executemany(self, query, param_rows):
+        '''
+        run a statement once for each set of parameters
+        '''
+        count('queries')
+        query, _params = self.convert_query(query, [])
+        param_rows = [self.convert_query(query, params)[1] for params in param_rows]
+        try:
+            self.conn.sqlite.executemany(query.rstrip().rstrip(';'), param_rows)
+        except sqlite3.Error as ex:
+            raise ProgrammingError(1064, str(ex)) from ex
+
+    def fetchone(self):
+        '''
+        return the next row or None
+        '''
+        if self.result is None:
+            return None
+        row = next(self.result, None)
+        if row is None:
+            return None
+        if self.counting:
+            self.conn.handler_reads += 1
+        return tuple(row)
+
+    def fetchmany(self, size=1):
+        '''
+        return a list of at most size rows
+        '''
+        rows = []
+        while len(rows) < size:
+            row = self.fetchone()
+            if row is None:
+                break
+            rows.append(row)
+        return rows
+
+    def fetchall(self):
+        '''
+        return all remaining rows
+        '''
+        if self.result is None:
+            return ()
+        rows = tuple(tuple(row) for row in self.result)
+        if self.counting:
+            self.conn.handler_reads += len(rows)
+        return rows
+
+    def close(self):
+        '''
+        drop any remaining rows
+        '''
+        self.result = None
+
+
+class SSCursor(Cursor):
+    '''
+    the unbuffered cursor; sqlite results are read lazily anyways
+    '''
+
+
+cursors = types.SimpleNamespace(Cursor=Cursor, SSCursor=SSCursor)
+
+
+class Connection():
+    '''
+    a connection to a "server", which can see any of the wiki dbs
+    in the data directory, one at a time
+    '''
+    def __init__(self, host=None, port=None, user=None, passwd=None, **_kwargs):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.sqlite = None
+        self.wikidb = None
+        self.closed = False
+        # rows fetched over this connection, see Cursor.execute
+        self.handler_reads = 0
+
+    def select_db(self, wikidb):
+        '''
+        switch to another wiki db; temporary tables go away as they would not in mariadb,
+        but nothing we do needs them to last past a db switch
+        '''
+        if wikidb == self.wikidb:
+            return
+        path = os.path.join(SETTINGS['datadir'], f"{wikidb}.sqlite")
+        if not os.path.exists(path):
+            raise OperationalError(1049, f"Unknown database '{wikidb}'")
+        if self.sqlite:
+            self.sqlite.close()
+        self.sqlite = sqlite3.connect(path, check_same_thread=False)
+        self.wikidb = wikidb
+
+    def cursor(self, cursorclass=None):
+        '''
+        return a new cursor of the given class (Cursor by default)
+        '''
+        if self.closed:
+            raise OperationalError(2006, "MySQL server has gone away")
+        return (cursorclass or Cursor)(self)
+
+    def ping(self, *_args):
+        '''
+        complain if the connection has been closed
+        '''
+        if self.closed:
+            raise OperationalError(2006, "MySQL server has gone away")
+
+    def commit(self):
+        '''
+        nothing to do
+        '''
+
+    def close(self):
+        '''
+        close the sqlite connection
+        '''
+        if self.sqlite:
+            self.sqlite.close()
+        self.sqlite = None
+        self.wikidb = None
+        self.closed = True
+
+
+def connect(**kwargs):
+    '''
+    return a new fake connection
+    '''
+    count('connects')
+    return Connection(**kwargs)